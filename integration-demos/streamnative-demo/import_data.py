@@ -9,7 +9,20 @@ from confluent_kafka.schema_registry.avro import AvroSerializer
 from confluent_kafka.serialization import StringSerializer,SerializationContext, MessageField
 
 
-DELAY_TIME = 0.01
+# Messages per second when producing the incremental data
+INCREMENTAL_RATE = 100
+# Producer batching defaults for throughput: wait up to LINGER_MS to fill batches of up to BATCH_SIZE bytes
+# and BATCH_MESSAGES messages (librdkafka's defaults are 5 ms, 1 MB and 10000 messages). A batch is also
+# capped by message.max.bytes, which is raised to match; keep it below the broker's maximum message size
+# (5 MB by default on StreamNative/Pulsar).
+LINGER_MS = 50
+BATCH_SIZE = 4 * 1024 * 1024
+BATCH_MESSAGES = 100000
+COMPRESSION = "lz4"
+# Seconds between progress reports
+REPORT_INTERVAL = 5
+# Characters read from the data file at a time
+READ_CHUNK_SIZE = 1 << 20
 SNAPSHOT_DATA_PATH = "data/snapshot_data.json"
 INCREMENTAL_DATA_PATH = "data/incremental_data.json"
 
@@ -299,13 +312,97 @@ def delivery_report(err, msg):
     print(f"Record {msg.key()} successfully produced to {msg.topic()} "
           f"[{msg.partition()}] at offset {msg.offset()}")
 
-def setup():
+class DeliveryStats:
+    """Delivery callback that counts delivered and failed messages instead of printing each one."""
+
+    def __init__(self, verbose=False):
+        self.verbose = verbose
+        self.produced = 0
+        self.delivered = 0
+        self.failed = 0
+        self.start = self.last_report = time.monotonic()
+        self.last_delivered = 0
+
+    def __call__(self, err, msg):
+        if err is not None:
+            self.failed += 1
+            # Failures are always worth a line
+            delivery_report(err, msg)
+        else:
+            self.delivered += 1
+            if self.verbose:
+                delivery_report(err, msg)
+
+    def report(self, final=False):
+        now = time.monotonic()
+        if final:
+            elapsed = now - self.start
+            print(f"Produced {self.produced} messages in {elapsed:.1f}s: {self.delivered} delivered, "
+                  f"{self.failed} failed, {self.delivered / max(elapsed, 1e-9):.0f} msgs/sec.")
+        else:
+            rate = (self.delivered - self.last_delivered) / max(now - self.last_report, 1e-9)
+            print(f"{self.produced} produced, {self.delivered} delivered, {self.failed} failed, "
+                  f"{rate:.0f} msgs/sec.")
+        self.last_report, self.last_delivered = now, self.delivered
+
+class TokenBucket:
+    """
+    Rate limit of rate messages per second with bursts of up to burst messages. take() returns
+    how long to wait before sending, so the caller can serve delivery reports meanwhile.
+    """
+
+    def __init__(self, rate, burst=None):
+        self.rate = rate
+        self.burst = burst or max(1.0, rate / 10)
+        self.tokens = self.burst
+        self.last = time.monotonic()
+
+    def take(self):
+        now = time.monotonic()
+        self.tokens = min(self.burst, self.tokens + (now - self.last) * self.rate)
+        self.last = now
+        self.tokens -= 1
+        return -self.tokens / self.rate if self.tokens < 0 else 0
+
+def iter_records(file_path, chunk_size=READ_CHUNK_SIZE):
+    """Yields the elements of the top-level JSON array in file_path without loading the whole file."""
+    decoder = json.JSONDecoder()
+    with open(file_path, 'r') as f:
+        buffer = f.read(chunk_size).lstrip()
+        if not buffer.startswith('['):
+            raise ValueError(f"{file_path} does not hold a JSON array")
+        position, eof = 1, False
+        while True:
+            # Skip the separators before the next element
+            while position < len(buffer) and buffer[position] in ' \t\r\n,':
+                position += 1
+            if position < len(buffer) and buffer[position] == ']':
+                return
+            try:
+                record, end = decoder.raw_decode(buffer, position)
+            except ValueError:
+                # The element continues in the next chunk
+                if eof:
+                    raise
+                chunk = f.read(chunk_size)
+                eof = not chunk
+                buffer, position = buffer[position:] + chunk, 0
+                continue
+            yield record
+            position = end
+
+def setup(linger_ms=LINGER_MS, batch_size=BATCH_SIZE, compression=COMPRESSION):
     producer_config = {
         'bootstrap.servers': SERVER_URL,
         'sasl.mechanism': 'PLAIN',
         'security.protocol': 'SASL_SSL',
         'sasl.username': 'user',
-        'sasl.password': PASSWORD
+        'sasl.password': PASSWORD,
+        'linger.ms': linger_ms,
+        'batch.size': batch_size,
+        'batch.num.messages': BATCH_MESSAGES,
+        'message.max.bytes': max(batch_size, 1000000),
+        'compression.type': compression
     }
     producer = Producer(producer_config)
     schema_registry_config = {
@@ -320,31 +417,48 @@ def setup():
     
     return producer, string_serializer, avro_serializer_dict
 
-def import_data(file_path, delay_time=0):
-    producer, string_serializer, avro_serializer_dict = setup()
-    with open(file_path, 'r') as f:
-        data_list = json.load(f)
-    for data in data_list:
+def import_data(file_path, rate=0, linger_ms=LINGER_MS, batch_size=BATCH_SIZE, compression=COMPRESSION,
+                report_interval=REPORT_INTERVAL, verbose=False):
+    """
+    Streams the records of file_path to their topics. With rate, a token bucket keeps the
+    average at rate messages per second. Delivery results are counted and reported every
+    report_interval seconds, and the sustained msgs/sec is printed at the end.
+    """
+    producer, string_serializer, avro_serializer_dict = setup(linger_ms, batch_size, compression)
+    stats = DeliveryStats(verbose)
+    bucket = TokenBucket(rate) if rate else None
+    for data in iter_records(file_path):
         table_name, data_value = data["table_name"], data["data_value"]
         topic = TOPIC_PREFIX + table_name
         avro_serializer = avro_serializer_dict[table_name]
         key_field = table_name + str(data_value.get(f"{table_name.lower()}Id"))
-        producer.produce(
-            topic = topic,
-            key = string_serializer(key_field),
-            value = avro_serializer(data_value, SerializationContext(topic, MessageField.VALUE)),
-            on_delivery = delivery_report
-        )
+        key = string_serializer(key_field)
+        value = avro_serializer(data_value, SerializationContext(topic, MessageField.VALUE))
+        if bucket:
+            # Serve delivery reports while waiting for the next token (poll returns early on events)
+            deadline = time.monotonic() + bucket.take()
+            while time.monotonic() < deadline:
+                producer.poll(deadline - time.monotonic())
+        while True:
+            try:
+                producer.produce(topic=topic, key=key, value=value, on_delivery=stats)
+                break
+            except BufferError:
+                # The local queue is full: wait for deliveries to make room
+                producer.poll(0.1)
+        stats.produced += 1
         producer.poll(0)
-        time.sleep(delay_time)
+        if time.monotonic() - stats.last_report >= report_interval:
+            stats.report()
 
     producer.flush()
+    stats.report(final=True)
 
-def import_snapshot_data():
-    import_data(SNAPSHOT_DATA_PATH)
+def import_snapshot_data(**options):
+    import_data(SNAPSHOT_DATA_PATH, **options)
 
-def import_incremental_data():
-    import_data(INCREMENTAL_DATA_PATH, delay_time=DELAY_TIME)
+def import_incremental_data(rate=INCREMENTAL_RATE, **options):
+    import_data(INCREMENTAL_DATA_PATH, rate=rate, **options)
 
 def main():
     parser = argparse.ArgumentParser(description='Import snapshot data and incremental data.')
@@ -352,16 +466,30 @@ def main():
     group = parser.add_mutually_exclusive_group(required=True)
     group.add_argument('-s', action='store_true', help='Import snapshot data.')
     group.add_argument('-i', action='store_true', help='Import incremental data.')
+    parser.add_argument('--rate', type=float, default=None,
+                        help=f'Messages per second, 0 for no limit (default: no limit for snapshot data, '
+                             f'{INCREMENTAL_RATE} for incremental data).')
+    parser.add_argument('--linger-ms', type=int, default=LINGER_MS,
+                        help=f'Producer linger.ms: how long to wait to fill a batch (default: {LINGER_MS}).')
+    parser.add_argument('--batch-size', type=int, default=BATCH_SIZE,
+                        help=f'Producer batch.size in bytes (default: {BATCH_SIZE}).')
+    parser.add_argument('--compression', choices=['none', 'gzip', 'snappy', 'lz4', 'zstd'], default=COMPRESSION,
+                        help=f'Producer compression.type (default: {COMPRESSION}).')
+    parser.add_argument('--report-interval', type=float, default=REPORT_INTERVAL,
+                        help=f'Seconds between progress reports (default: {REPORT_INTERVAL}).')
+    parser.add_argument('--verbose', action='store_true', help='Print every delivered message.')
     args = parser.parse_args()
+    options = {'linger_ms': args.linger_ms, 'batch_size': args.batch_size, 'compression': args.compression,
+               'report_interval': args.report_interval, 'verbose': args.verbose}
     
     if args.s:
         print("Importing snapshot data...")
-        import_snapshot_data()
+        import_snapshot_data(rate=args.rate or 0, **options)
         print("Finished importing snapshot data.")
         
     if args.i:
         print("Importing incremental data...")
-        import_incremental_data()
+        import_incremental_data(rate=INCREMENTAL_RATE if args.rate is None else args.rate, **options)
         print("Finished importing incremental data.")
 
 
@@ -1,21 +1,86 @@
 import argparse
+import hashlib
+import json
 import os
+import re
+import shutil
+import time
+from concurrent.futures import ProcessPoolExecutor
 
 import pandas as pd
+import pyarrow as pa
+import pyarrow.csv as pv
+import pyarrow.dataset as ds
+import pyarrow.parquet as pq
 
 """
 Script to convert CSV file(s) to Parquet format.
 
 Usage:
-    python your_script.py <csv_file_or_folder> <output_folder>
+    python your_script.py <csv_file_or_folder> <output_folder> [options]
 
     Example:
     python your_script.py parts_lorem.csv ./parquet_output
     python your_script.py ./csv_folder ./parquet_output
+    python your_script.py ./csv_folder ./parquet_output --streaming --row-group-size 500000 --max-memory-mb 512
+    python your_script.py ./csv_folder ./parquet_output --workers 8
+    python your_script.py ./csv_folder ./parquet_output --schema schema.json
+    python your_script.py ./csv_folder ./parquet_output --partition-by region --sort-by created_at
+    python your_script.py ./csv_folder ./parquet_output --compression zstd:3 --byte-stream-split
+    python your_script.py ./csv_folder ./parquet_output --benchmark
 
     This will convert the specified CSV file or all CSV files in the specified folder 
     to Parquet format and save them in the provided output folder.
 
+    By default each CSV file is loaded into memory with pandas. With --streaming the file is
+    read in bounded record batches with pyarrow's streaming CSV reader and appended to a single
+    Parquet file, so peak memory no longer grows with the size of the CSV file. In streaming mode
+    column types are inferred from the first block of the file; when a later value does not fit,
+    the column is widened (null to string, int64 to double, anything else to string) and the file
+    is converted again. Columns given by --schema are never widened.
+
+    With --partition-by, <name>.parquet is a directory of hive-style <column>=<value> partitions
+    instead of a single file; it is read back with the same path. With --sort-by, rows are sorted
+    so that the min/max statistics of each row group let query engines skip row groups. Streaming
+    mode only sorts the rows within each row group.
+
+    --benchmark writes nothing to the output folder. Instead it converts a sample of each CSV file
+    in memory with a range of codec and encoding settings and reports the output size, write time
+    and full-scan read time of each, so the settings can be chosen from the data.
+
+    A manifest (.csv_to_parquet_manifest.json) in the output folder records the size, mtime and
+    content hash of every converted CSV file together with the conversion options. On a re-run,
+    files that are unchanged are skipped; changed files are rewritten through a temporary file
+    that is renamed into place, so a Parquet file is never left half written.
+
+Options:
+    --streaming           Read the CSV in record batches instead of loading it all at once.
+    --row-group-size N    Maximum number of rows per Parquet row group.
+    --max-memory-mb N     Approximate memory ceiling for streaming mode; bounds both the CSV read
+                          block size and the rows buffered before a row group is flushed.
+    --workers N           Convert the files of a folder in N parallel processes. A failing file is
+                          reported and skipped without stopping the others.
+    --schema FILE         Column types to parse into instead of inferring them. Either the demo's
+                          PuppyGraph schema.json, whose vertex/edge tableSource tables are matched
+                          to CSV file names, or a plain {"<table>": {"<column>": "<TYPE>"}} map.
+                          Names match regardless of case and a plural "s", so artifacts.csv gets the
+                          types of table Artifact; CSV files with no match are reported.
+                          Supported types: STRING, SHORT, INT, LONG, FLOAT, DOUBLE, BOOLEAN, DATE,
+                          DATETIME. Columns that are not listed are still inferred.
+    --table-map MAP       Comma-separated csv_name=table pairs for CSV files whose names don't match
+                          a schema table, e.g. deps=Dependency.
+    --partition-by COLS   Comma-separated, low-cardinality columns to partition the output by.
+    --sort-by COLS        Comma-separated columns to sort the rows by. Partition and sort columns
+                          a CSV file does not have are ignored for that file.
+    --compression CODEC   Codec for all columns: snappy (default), lz4, zstd, gzip, brotli or none,
+                          with an optional level, e.g. zstd:9.
+    --column-compression  Per-column codecs overriding --compression, e.g. payload=zstd:9,id=lz4.
+    --no-dictionary       Disable dictionary encoding.
+    --byte-stream-split   Use byte-stream-split encoding for floating point columns.
+    --benchmark           Report size, write and read time of each codec setting on a sample.
+    --benchmark-rows N    Number of rows sampled from each CSV file by --benchmark.
+    --force               Ignore the manifest and convert every file again.
+
 Dependencies:
     - pandas
     - pyarrow
@@ -24,27 +89,445 @@ Install dependencies:
     pip install pandas pyarrow
 """
 
+DEFAULT_ROW_GROUP_SIZE = 1024 * 1024
+DEFAULT_COMPRESSION = "snappy"
+DEFAULT_BENCHMARK_ROWS = 100000
+MANIFEST_FILE = ".csv_to_parquet_manifest.json"
+
+# PuppyGraph attribute types and the Arrow types they are parsed into
+SCHEMA_TYPES = {
+  "STRING": pa.string(),
+  "SHORT": pa.int16(),
+  "INT": pa.int32(),
+  "INTEGER": pa.int32(),
+  "LONG": pa.int64(),
+  "FLOAT": pa.float32(),
+  "DOUBLE": pa.float64(),
+  "BOOLEAN": pa.bool_(),
+  "DATE": pa.date32(),
+  "DATETIME": pa.timestamp("us"),
+}
+
+# Types a streamed column is widened to when a later block has values its inferred type can't hold
+WIDER_TYPES = {
+  "null": pa.string(),
+  "int64": pa.float64(),
+}
+CONVERSION_ERROR_PATTERN = re.compile(r"CSV column #(\d+): .*CSV conversion error to (\w+)")
+
+# Codec and encoding settings compared by --benchmark
+BENCHMARK_SETTINGS = [
+  ("none", {"compression": "none"}),
+  ("snappy", {"compression": "snappy"}),
+  ("lz4", {"compression": "lz4"}),
+  ("zstd:1", {"compression": "zstd:1"}),
+  ("zstd:3", {"compression": "zstd:3"}),
+  ("zstd:9", {"compression": "zstd:9"}),
+  ("zstd:3 no-dictionary", {"compression": "zstd:3", "use_dictionary": False}),
+  ("zstd:3 byte-stream-split", {"compression": "zstd:3", "byte_stream_split": True}),
+]
+
+
+def load_table_types(schema_file):
+  # Build a {table: {column: arrow type}} map from a PuppyGraph schema.json or a plain dtype map
+  with open(schema_file) as f:
+    schema = json.load(f)
+
+  if "graph" not in schema:
+    return {table: {column: SCHEMA_TYPES[type_name.upper()] for column, type_name in columns.items()}
+            for table, columns in schema.items()}
+
+  table_types = {}
+  graph = schema["graph"]
+  for element in graph.get("vertices", []) + graph.get("edges", []):
+    mapping = element.get("oneToOne", element)
+    table = mapping["tableSource"]["table"]
+    fields = []
+    for key in ("id", "fromId", "toId"):
+      fields += mapping.get(key, {}).get("fields", [])
+    fields += mapping.get("attributes", [])
+    for field in fields:
+      if field["type"].upper() in SCHEMA_TYPES:
+        table_types.setdefault(table, {}).setdefault(field["field"], SCHEMA_TYPES[field["type"].upper()])
+  return table_types
+
+
+def table_key(name):
+  # Case and plural-insensitive form of a table or CSV file name, so "artifacts" matches "Artifact"
+  key = re.sub(r"[^0-9a-z]", "", name.lower())
+  if key.endswith("ies"):
+    return key[:-3] + "y"
+  return key[:-1] if key.endswith("s") else key
+
+
+def file_column_types(csv_file, table_types, table_map=None):
+  # Find the column types of a CSV file: its --table-map entry, the table of the same name,
+  # or else the one table whose name matches regardless of case and plural
+  if not table_types:
+    return None
+  table = os.path.splitext(os.path.basename(csv_file))[0]
+  table = (table_map or {}).get(table, table)
+  if table in table_types:
+    return table_types[table]
+  matches = [name for name in table_types if table_key(name) == table_key(table)]
+  if len(matches) == 1:
+    return table_types[matches[0]]
+  print(f"Warning: no table in the schema matches CSV file {csv_file}; its column types are inferred. "
+        f"Use --table-map to name its table.")
+  return None
+
+
+def csv_options(column_types):
+  # Parse listed columns straight into their target types; empty strings are nulls, as with pandas
+  return pv.ConvertOptions(column_types=column_types or {}, strings_can_be_null=True)
+
+
+def parse_codec(codec):
+  # "zstd:9" -> ("zstd", 9), "snappy" -> ("snappy", None)
+  name, _, level = codec.partition(":")
+  return name.lower(), int(level) if level else None
+
+
+def writer_options(schema, compression=None, column_compression=None, use_dictionary=True,
+                   byte_stream_split=False):
+  # Resolve the codec and encoding settings into Parquet writer arguments for one table
+  codecs = {column: parse_codec(compression or DEFAULT_COMPRESSION) for column in schema.names}
+  codecs.update({column: parse_codec(codec) for column, codec in (column_compression or {}).items()
+                 if column in codecs})
+  levels = {column: level for column, (_, level) in codecs.items() if level is not None}
+
+  # Dictionary encoding takes precedence over byte-stream-split, so split columns are left out of it
+  split_columns = [field.name for field in schema if pa.types.is_floating(field.type)] if byte_stream_split else []
+  return {
+    "compression": {column: name for column, (name, _) in codecs.items()},
+    "compression_level": levels or None,
+    "use_dictionary": [column for column in schema.names if column not in split_columns] if use_dictionary else False,
+    "use_byte_stream_split": split_columns or False,
+  }
+
+
+def parquet_path(csv_file, output_folder):
+  # Generate the Parquet file name in the output folder
+  return os.path.join(output_folder, os.path.basename(csv_file).replace('.csv', '.parquet'))
+
+
+def file_hash(path):
+  # Hash the file in chunks so large CSV files are never fully loaded
+  digest = hashlib.sha256()
+  with open(path, "rb") as f:
+    for chunk in iter(lambda: f.read(1024 * 1024), b""):
+      digest.update(chunk)
+  return digest.hexdigest()
+
+
+def options_key(options):
+  # Fingerprint of the conversion options, so changing them invalidates the manifest entries
+  return hashlib.sha256(json.dumps(options, sort_keys=True, default=str).encode()).hexdigest()
+
+
+def load_manifest(output_folder):
+  manifest_file = os.path.join(output_folder, MANIFEST_FILE)
+  if not os.path.exists(manifest_file):
+    return {}
+  with open(manifest_file) as f:
+    return json.load(f)
+
+
+def save_manifest(output_folder, manifest):
+  manifest_file = os.path.join(output_folder, MANIFEST_FILE)
+  with open(manifest_file + ".tmp", "w") as f:
+    json.dump(manifest, f, indent=2, sort_keys=True)
+  os.replace(manifest_file + ".tmp", manifest_file)
+
+
+def source_entry(csv_file, options, previous=None):
+  # Describe the source file; the content hash is reused when size and mtime are unchanged
+  stat = os.stat(csv_file)
+  entry = {"size": stat.st_size, "mtime": stat.st_mtime, "options": options_key(options)}
+  if previous and previous.get("size") == entry["size"] and previous.get("mtime") == entry["mtime"]:
+    entry["sha256"] = previous["sha256"]
+  else:
+    entry["sha256"] = file_hash(csv_file)
+  return entry
+
+
+def is_unchanged(entry, previous, parquet_file):
+  return (previous is not None and os.path.exists(parquet_file) and previous["sha256"] == entry["sha256"]
+          and previous["options"] == entry["options"] and previous["size"] == entry["size"])
+
+
+def stream_row_groups(reader, row_group_size, max_buffer_bytes=None):
+  # Collect record batches into row-group sized tables, flushing early at the memory ceiling
+  pending, pending_rows, pending_bytes = [], 0, 0
+  for batch in reader:
+    pending.append(batch)
+    pending_rows += batch.num_rows
+    pending_bytes += batch.nbytes
+    if pending_rows >= row_group_size or (max_buffer_bytes and pending_bytes >= max_buffer_bytes):
+      yield pa.Table.from_batches(pending, reader.schema)
+      pending, pending_rows, pending_bytes = [], 0, 0
+  if pending:
+    yield pa.Table.from_batches(pending, reader.schema)
+
+
+def table_columns(columns, schema):
+  # Partition and sort columns are given for a whole folder; each table uses the ones it has
+  return [column for column in columns or [] if column in schema.names]
+
+
+def sort_table(table, sort_by):
+  return table.sort_by([(column, "ascending") for column in sort_by]) if sort_by else table
 
-def csv_to_parquet(csv_file, output_folder):
-  # Read the CSV file
-  df = pd.read_csv(csv_file)
 
-  # Generate the Parquet file name and save it in the output folder
-  parquet_file = os.path.join(output_folder, os.path.basename(csv_file).replace('.csv', '.parquet'))
+def write_partitioned(data, parquet_dir, partition_by, row_group_size, schema, parquet_options):
+  # Write hive-style <column>=<value> directories below the table's output directory
+  file_options = ds.ParquetFileFormat().make_write_options(**writer_options(schema, **parquet_options))
+  ds.write_dataset(data, parquet_dir, schema=schema, format="parquet", file_options=file_options,
+                   partitioning=partition_by, partitioning_flavor="hive", basename_template="part-{i}.parquet",
+                   max_rows_per_group=row_group_size, min_rows_per_group=0)
+
+
+def stream_read_options(max_memory_mb=None):
+  read_options = pv.ReadOptions()
+  max_buffer_bytes = None
+  if max_memory_mb:
+    # Split the ceiling between the CSV read block and the rows waiting to be flushed
+    max_memory_bytes = max_memory_mb * 1024 * 1024
+    read_options.block_size = max(max_memory_bytes // 4, 1024 * 1024)
+    max_buffer_bytes = max_memory_bytes // 2
+  return read_options, max_buffer_bytes
+
+
+def widen_column_type(error, csv_file, read_options, column_types, declared_types):
+  # Pick a wider type for the column a streamed conversion failed on; None if it can't be widened
+  match = CONVERSION_ERROR_PATTERN.search(str(error))
+  if not match:
+    return None
+  with pv.open_csv(csv_file, read_options=read_options) as reader:
+    column = reader.schema.names[int(match.group(1))]
+  column_type = WIDER_TYPES.get(match.group(2), pa.string())
+  if column in declared_types or column_types.get(column) == column_type:
+    return None
+  return column, column_type
+
+
+def stream_csv_to_parquet(csv_file, parquet_file, row_group_size=None, max_memory_mb=None, column_types=None,
+                          partition_by=None, sort_by=None, parquet_options=None):
+  # Types are inferred from the first block, so a column whose later values don't fit is widened
+  # and the file converted again
+  declared_types = column_types or {}
+  column_types = dict(declared_types)
+  read_options, _ = stream_read_options(max_memory_mb)
+  while True:
+    try:
+      return write_csv_stream(csv_file, parquet_file, row_group_size, max_memory_mb, column_types, partition_by,
+                              sort_by, parquet_options)
+    except pa.ArrowInvalid as e:
+      widened = widen_column_type(e, csv_file, read_options, column_types, declared_types)
+      if not widened:
+        raise pa.ArrowInvalid(f"{e} (declare the column's type with --schema, or convert without --streaming)")
+      column, column_type = widened
+      print(f"Column {column} of {csv_file} has values that don't fit the type inferred from the first block; "
+            f"converting again with it as {column_type}.")
+      column_types[column] = column_type
+      remove_output(parquet_file)
+
+
+def write_csv_stream(csv_file, parquet_file, row_group_size=None, max_memory_mb=None, column_types=None,
+                     partition_by=None, sort_by=None, parquet_options=None):
+  row_group_size = row_group_size or DEFAULT_ROW_GROUP_SIZE
+  parquet_options = parquet_options or {}
+  read_options, max_buffer_bytes = stream_read_options(max_memory_mb)
+
+  rows = 0
+  with pv.open_csv(csv_file, read_options=read_options, convert_options=csv_options(column_types)) as reader:
+    partition_by = table_columns(partition_by, reader.schema)
+    sort_by = table_columns(sort_by, reader.schema)
+    # Rows can only be sorted within each flushed row group, as the file is never held in memory
+    row_groups = (sort_table(table, sort_by) for table in stream_row_groups(reader, row_group_size, max_buffer_bytes))
+    if partition_by:
+      def batches():
+        nonlocal rows
+        for table in row_groups:
+          rows += table.num_rows
+          yield from table.to_batches()
+      write_partitioned(batches(), parquet_file, partition_by, row_group_size, reader.schema, parquet_options)
+    else:
+      with pq.ParquetWriter(parquet_file, reader.schema, **writer_options(reader.schema, **parquet_options)) as writer:
+        for table in row_groups:
+          writer.write_table(table, row_group_size=row_group_size)
+          rows += table.num_rows
+  return rows
+
+
+def write_parquet(csv_file, parquet_file, streaming, row_group_size, max_memory_mb, column_types,
+                  partition_by, sort_by, parquet_options):
+  if streaming:
+    # Convert the CSV to Parquet batch by batch
+    return stream_csv_to_parquet(csv_file, parquet_file, row_group_size, max_memory_mb, column_types,
+                                 partition_by, sort_by, parquet_options)
+
+  if column_types:
+    # Parse the CSV file straight into the declared types
+    table = pv.read_csv(csv_file, convert_options=csv_options(column_types))
+  else:
+    # Read the CSV file
+    table = pa.Table.from_pandas(pd.read_csv(csv_file), preserve_index=False)
+
+  # Sort the whole file so the min/max statistics of every row group are selective
+  partition_by = table_columns(partition_by, table.schema)
+  table = sort_table(table, table_columns(sort_by, table.schema))
 
   # Convert the CSV to Parquet
-  df.to_parquet(parquet_file, engine='pyarrow', index=False)
+  if partition_by:
+    write_partitioned(table, parquet_file, partition_by, row_group_size or DEFAULT_ROW_GROUP_SIZE, table.schema,
+                      parquet_options)
+  else:
+    pq.write_table(table, parquet_file, row_group_size=row_group_size,
+                   **writer_options(table.schema, **parquet_options))
+  return table.num_rows
+
+
+def remove_output(path):
+  if os.path.isdir(path):
+    shutil.rmtree(path)
+  elif os.path.exists(path):
+    os.remove(path)
+
+
+def replace_output(src, dst):
+  # A partitioned output is a directory, which can't be renamed over an existing one
+  if os.path.isdir(src) or os.path.isdir(dst):
+    remove_output(dst + ".old")
+    if os.path.exists(dst):
+      os.replace(dst, dst + ".old")
+    os.replace(src, dst)
+    remove_output(dst + ".old")
+  else:
+    os.replace(src, dst)
+
+
+def output_size(path):
+  if os.path.isfile(path):
+    return os.path.getsize(path)
+  return sum(os.path.getsize(os.path.join(root, name)) for root, _, names in os.walk(path) for name in names)
 
-  print(f"CSV file {csv_file} has been successfully converted to Parquet. Output file: {parquet_file}")
 
+def csv_to_parquet(csv_file, output_folder, streaming=False, row_group_size=None, max_memory_mb=None,
+                   table_types=None, partition_by=None, sort_by=None, parquet_options=None, table_map=None):
+  parquet_file = parquet_path(csv_file, output_folder)
+  column_types = file_column_types(csv_file, table_types, table_map)
 
-def process_folder(folder_path, output_folder):
-  # Loop through all files in the directory
-  for file_name in os.listdir(folder_path):
-    # Check if the file is a CSV file
-    if file_name.endswith(".csv"):
-      csv_file_path = os.path.join(folder_path, file_name)
-      csv_to_parquet(csv_file_path, output_folder)
+  # Write to a temporary file and rename it into place once the conversion is complete
+  final_file, parquet_file = parquet_file, parquet_file + ".tmp"
+  remove_output(parquet_file)
+  try:
+    rows = write_parquet(csv_file, parquet_file, streaming, row_group_size, max_memory_mb, column_types,
+                         partition_by, sort_by, parquet_options or {})
+    replace_output(parquet_file, final_file)
+  finally:
+    remove_output(parquet_file)
+
+  return rows, output_size(final_file)
+
+
+def read_sample(csv_file, column_types, sample_rows):
+  # Read only as many batches as the sample needs
+  batches, rows = [], 0
+  with pv.open_csv(csv_file, convert_options=csv_options(column_types)) as reader:
+    for batch in reader:
+      batches.append(batch)
+      rows += batch.num_rows
+      if rows >= sample_rows:
+        break
+    return pa.Table.from_batches(batches, reader.schema).slice(0, sample_rows)
+
+
+def benchmark_file(csv_file, table_types=None, sort_by=None, sample_rows=DEFAULT_BENCHMARK_ROWS, table_map=None, **_):
+  column_types = file_column_types(csv_file, table_types, table_map)
+  table = read_sample(csv_file, column_types, sample_rows)
+  table = sort_table(table, table_columns(sort_by, table.schema))
+
+  print(f"CSV file {csv_file}: {table.num_rows} sample rows, {table.nbytes} bytes in memory")
+  print(f"  {'setting':<26} {'size (bytes)':>14} {'write (ms)':>11} {'read (ms)':>11}")
+  for label, settings in BENCHMARK_SETTINGS:
+    sink = pa.BufferOutputStream()
+    start = time.perf_counter()
+    pq.write_table(table, sink, **writer_options(table.schema, **settings))
+    write_time = time.perf_counter() - start
+
+    buffer = sink.getvalue()
+    start = time.perf_counter()
+    pq.read_table(pa.BufferReader(buffer))
+    read_time = time.perf_counter() - start
+    print(f"  {label:<26} {buffer.size:>14} {write_time * 1000:>11.1f} {read_time * 1000:>11.1f}")
+
+
+def convert_file(csv_file, output_folder, options, previous=None):
+  # Run a single conversion, turning any failure into a result so one bad file can't stop the others
+  try:
+    entry = source_entry(csv_file, options, previous)
+    if is_unchanged(entry, previous, parquet_path(csv_file, output_folder)):
+      return {"rows": 0, "bytes": 0, "error": None, "skipped": True, "entry": entry}
+    rows, bytes_written = csv_to_parquet(csv_file, output_folder, **options)
+    return {"rows": rows, "bytes": bytes_written, "error": None, "skipped": False, "entry": entry}
+  except Exception as e:
+    return {"rows": 0, "bytes": 0, "error": f"{type(e).__name__}: {e}", "skipped": False, "entry": None}
+
+
+def process_files(csv_files, output_folder, workers=1, force=False, **options):
+  manifest = {} if force else load_manifest(output_folder)
+  previous = {csv_file: manifest.get(os.path.basename(csv_file)) for csv_file in csv_files}
+
+  start = time.time()
+  if workers > 1:
+    executor = ProcessPoolExecutor(max_workers=workers)
+    futures = [executor.submit(convert_file, csv_file, output_folder, options, previous[csv_file])
+               for csv_file in csv_files]
+    results = (future.result() for future in futures)
+  else:
+    executor = None
+    results = (convert_file(csv_file, output_folder, options, previous[csv_file]) for csv_file in csv_files)
+
+  # Report progress in file order, whichever worker finishes first
+  total_rows, total_bytes, skipped, failed = 0, 0, 0, []
+  for index, (csv_file, result) in enumerate(zip(csv_files, results), start=1):
+    if result["error"]:
+      failed.append(csv_file)
+      manifest.pop(os.path.basename(csv_file), None)
+      print(f"[{index}/{len(csv_files)}] Failed to convert CSV file {csv_file}: {result['error']}")
+      continue
+    # Record the file in the manifest as soon as its Parquet output is in place
+    manifest[os.path.basename(csv_file)] = result["entry"]
+    save_manifest(output_folder, manifest)
+    if result["skipped"]:
+      skipped += 1
+      print(f"[{index}/{len(csv_files)}] CSV file {csv_file} is unchanged. Skipping.")
+      continue
+    total_rows += result["rows"]
+    total_bytes += result["bytes"]
+    print(f"[{index}/{len(csv_files)}] CSV file {csv_file} has been successfully converted to Parquet. "
+          f"Output file: {parquet_path(csv_file, output_folder)} ({result['rows']} rows)")
+  if executor:
+    executor.shutdown()
+
+  elapsed = max(time.time() - start, 1e-9)
+  converted = len(csv_files) - len(failed) - skipped
+  print(f"Converted {converted}/{len(csv_files)} files ({skipped} unchanged): {total_rows} rows, {total_bytes} bytes "
+        f"in {elapsed:.2f}s ({total_rows / elapsed:.0f} rows/s, {total_bytes / elapsed / (1024 * 1024):.2f} MB/s)")
+  if failed:
+    print(f"Failed files: {', '.join(failed)}")
+  return failed
+
+
+def list_csv_files(folder_path):
+  # Collect all CSV files in the directory
+  return [os.path.join(folder_path, file_name) for file_name in sorted(os.listdir(folder_path))
+          if file_name.endswith(".csv")]
+
+
+def process_folder(folder_path, output_folder, **options):
+  return process_files(list_csv_files(folder_path), output_folder, **options)
 
 
 if __name__ == "__main__":
@@ -52,9 +535,66 @@ if __name__ == "__main__":
   parser = argparse.ArgumentParser(description="Convert CSV file(s) to Parquet format.")
   parser.add_argument("csv_file_or_folder", help="The path to the CSV file or folder to convert.")
   parser.add_argument("output_folder", help="The folder where the Parquet files will be saved.")
+  parser.add_argument("--streaming", action="store_true",
+                      help="Read the CSV in bounded record batches instead of loading it all into memory.")
+  parser.add_argument("--row-group-size", type=int, default=None,
+                      help="Maximum number of rows per Parquet row group.")
+  parser.add_argument("--max-memory-mb", type=int, default=None,
+                      help="Approximate memory ceiling in MB for streaming mode.")
+  parser.add_argument("--workers", type=int, default=1,
+                      help="Number of processes used to convert the files of a folder in parallel.")
+  parser.add_argument("--schema", default=None,
+                      help="PuppyGraph schema.json or {table: {column: TYPE}} JSON file with the column types.")
+  parser.add_argument("--table-map", default=None,
+                      type=lambda value: dict(item.split("=", 1) for item in value.split(",")),
+                      help="Comma-separated csv_name=table pairs matching CSV files to schema tables.")
+  parser.add_argument("--partition-by", type=lambda value: value.split(","), default=None,
+                      help="Comma-separated columns to write hive-style partition directories for.")
+  parser.add_argument("--sort-by", type=lambda value: value.split(","), default=None,
+                      help="Comma-separated columns to sort the rows by before they are written.")
+  parser.add_argument("--compression", default=None,
+                      help="Codec for all columns, optionally with a level, e.g. snappy, lz4, zstd:3.")
+  parser.add_argument("--column-compression", default=None,
+                      type=lambda value: dict(item.split("=", 1) for item in value.split(",")),
+                      help="Comma-separated column=codec[:level] overrides, e.g. payload=zstd:9,id=lz4.")
+  parser.add_argument("--no-dictionary", action="store_true",
+                      help="Disable dictionary encoding.")
+  parser.add_argument("--byte-stream-split", action="store_true",
+                      help="Use byte-stream-split encoding for floating point columns.")
+  parser.add_argument("--benchmark", action="store_true",
+                      help="Compare codec and encoding settings on a sample of each CSV file instead of converting.")
+  parser.add_argument("--benchmark-rows", type=int, default=DEFAULT_BENCHMARK_ROWS,
+                      help="Number of rows sampled from each CSV file by --benchmark.")
+  parser.add_argument("--force", action="store_true",
+                      help="Convert every file even if the manifest shows it is unchanged.")
 
   # Parse the command-line arguments
   args = parser.parse_args()
+  options = {
+    "streaming": args.streaming,
+    "row_group_size": args.row_group_size,
+    "max_memory_mb": args.max_memory_mb,
+    "table_types": load_table_types(args.schema) if args.schema else None,
+    "table_map": args.table_map,
+    "partition_by": args.partition_by,
+    "sort_by": args.sort_by,
+    "parquet_options": {
+      "compression": args.compression,
+      "column_compression": args.column_compression,
+      "use_dictionary": not args.no_dictionary,
+      "byte_stream_split": args.byte_stream_split,
+    },
+  }
+
+  if args.benchmark:
+    # Compare codec settings on a sample of each file instead of converting
+    if os.path.isdir(args.csv_file_or_folder):
+      csv_files = list_csv_files(args.csv_file_or_folder)
+    else:
+      csv_files = [args.csv_file_or_folder]
+    for csv_file in csv_files:
+      benchmark_file(csv_file, sample_rows=args.benchmark_rows, **options)
+    raise SystemExit(0)
 
   # Check if the output folder exists, if not, create it
   if not os.path.exists(args.output_folder):
@@ -63,9 +603,14 @@ if __name__ == "__main__":
   # Check if the input is a file or a folder
   if os.path.isfile(args.csv_file_or_folder):
     # If it's a file, convert the single CSV file
-    csv_to_parquet(args.csv_file_or_folder, args.output_folder)
+    failed = process_files([args.csv_file_or_folder], args.output_folder, force=args.force, **options)
   elif os.path.isdir(args.csv_file_or_folder):
     # If it's a folder, process all CSV files in the folder
-    process_folder(args.csv_file_or_folder, args.output_folder)
+    failed = process_folder(args.csv_file_or_folder, args.output_folder, workers=args.workers, force=args.force,
+                            **options)
   else:
+    failed = None
     print(f"The path {args.csv_file_or_folder} is neither a file nor a directory.")
+
+  if failed:
+    raise SystemExit(1)
@@ -1,24 +1,441 @@
 #!/usr/bin/env python3
 import argparse
+import codecs
+import collections
+import datetime
+import decimal
+import gzip
+import hashlib
 import json
 import os
+import pickle
+import re
+import shutil
+import sqlite3
+import time
 import uuid
+from concurrent.futures import ProcessPoolExecutor
 
 import ijson
-import pandas as pd
-from faker import Faker
+import pyarrow as pa
+import pyarrow.parquet as pq
 
-# Initialize Faker for generating sample account details
-fake = Faker()
+# Namespace of the stable, name-based (UUIDv5) resource and session IDs
+ID_NAMESPACE = uuid.uuid5(uuid.NAMESPACE_DNS, "cloudtrail.puppygraph.com")
 
+# How the sample account alias, email and phone are generated (see account_details())
+ACCOUNT_DETAILS_MODES = ("faker", "hash", "none")
+FIRST_NAMES = ["alex", "bailey", "casey", "dana", "eli", "finley", "gray", "harper", "indy", "jordan", "kai",
+               "logan", "morgan", "noel", "oakley", "parker", "quinn", "reese", "sage", "taylor", "uma", "val",
+               "wren", "xan", "yael", "zion", "ari", "blair", "cruz", "drew", "emery", "frankie"]
+LAST_NAMES = ["adams", "brooks", "chen", "diaz", "evans", "fischer", "garcia", "hughes", "ito", "jensen", "khan",
+              "lopez", "miller", "nguyen", "olsen", "patel", "quist", "rossi", "silva", "tanaka", "ueda", "vogel",
+              "walsh", "xu", "young", "zhang", "abe", "bauer", "costa", "dubois", "eriksen", "ferreira"]
 
-def generate_session_id(identity_id, creation_date):
-  """Generate a simple session_id by concatenating identity_id and creation_date."""
+# Rows buffered per table before they are flushed to Parquet as one row group
+DEFAULT_BATCH_ROWS = 100000
+
+# Arrow schema of each output table; the table name is also the Parquet file name
+TABLE_SCHEMAS = {
+  "Account": pa.schema([
+    ("account_id", pa.string()),
+    ("account_alias", pa.string()),
+    ("email", pa.string()),
+    ("phone", pa.string()),
+  ]),
+  "Identity": pa.schema([
+    ("identity_id", pa.string()),
+    ("type", pa.string()),
+    ("principal_id", pa.string()),
+    ("arn", pa.string()),
+    ("user_name", pa.string()),
+    ("account_id", pa.string()),
+  ]),
+  "Session": pa.schema([
+    ("session_id", pa.string()),
+    ("creation_date", pa.string()),
+    ("mfa_authenticated", pa.bool_()),
+    ("additional_info", pa.string()),
+    ("identity_id", pa.string()),
+  ]),
+  "Event": pa.schema([
+    ("event_id", pa.string()),
+    ("event_time", pa.string()),
+    ("event_source", pa.string()),
+    ("event_name", pa.string()),
+    ("source_ip", pa.string()),
+    ("user_agent", pa.string()),
+    ("request_params", pa.string()),
+    ("response_params", pa.string()),
+    ("identity_id", pa.string()),
+    ("session_id", pa.string()),
+    ("account_id", pa.string()),
+  ]),
+  "Resource": pa.schema([
+    ("resource_id", pa.string()),
+    ("resource_name", pa.string()),
+    ("resource_type", pa.string()),
+    ("additional_metadata", pa.string()),
+  ]),
+  "EventResource": pa.schema([
+    ("event_id", pa.string()),
+    ("resource_id", pa.string()),
+    ("pre_state", pa.string()),
+    ("post_state", pa.string()),
+  ]),
+}
+
+# Natural key used to deduplicate the rows of each table
+DEDUP_KEYS = {
+  "Account": "account_id",
+  "Identity": "identity_id",
+  "Session": "session_id",
+  "Resource": "resource_name",
+}
+
+# CloudTrail delivers logs as AWSLogs/<account>/CloudTrail/<region>/YYYY/MM/DD/*.json.gz,
+# with file names like <account>_CloudTrail_<region>_YYYYMMDDTHHMMZ_<id>.json.gz
+DATE_PATH_PATTERN = re.compile(r"(?:^|/)(\d{4})/(\d{2})/(\d{2})(?:/|$)")
+DATE_NAME_PATTERN = re.compile(r"_(\d{4})(\d{2})(\d{2})T\d{4}Z")
+
+# requestParameters keys promoted to typed Event columns when --promote-keys is given without keys
+DEFAULT_PROMOTED_KEYS = ["bucketName", "instanceId", "roleName", "userName", "policyArn", "functionName"]
+
+# Column types a promoted key can ask for ("key:type"); values of another JSON type become null
+PROMOTED_TYPES = {"string": pa.string(), "int64": pa.int64(), "float64": pa.float64(), "bool": pa.bool_()}
+
+# Record members whose original JSON text is passed through by the raw reader, and its buffer size
+RAW_FIELDS = ("requestParameters", "responseElements")
+RAW_CHUNK_BYTES = 4 * 1024 * 1024
+RECORDS_PATTERN = re.compile(r'"Records"\s*:\s*\[')
+SEPARATOR_PATTERN = re.compile(r"[ \t\n\r,]*")
+WHITESPACE_PATTERN = re.compile(r"[ \t\n\r]*")
+
+
+class TableWriter:
+  """
+    Buffer rows for one table column by column and append them to a Parquet file
+    as a row group every time batch_rows rows have been collected.
+    """
+
+  def __init__(self, out_file, schema, batch_rows=DEFAULT_BATCH_ROWS):
+    self.out_file = out_file
+    self.schema = schema
+    self.batch_rows = batch_rows
+    self.writer = pq.ParquetWriter(out_file, schema)
+    self.columns = {name: [] for name in schema.names}
+    self.buffered = 0
+    self.rows = 0
+
+  def append(self, row):
+    for name, values in self.columns.items():
+      values.append(row[name])
+    self.buffered += 1
+    if self.buffered >= self.batch_rows:
+      self.flush()
+
+  def write_batch(self, batch):
+    # Write an already built record batch after the rows buffered before it
+    self.flush()
+    self.writer.write_batch(batch)
+    self.rows += batch.num_rows
+
+  def flush(self):
+    if not self.buffered:
+      return
+    self.writer.write_table(pa.Table.from_pydict(self.columns, schema=self.schema))
+    self.rows += self.buffered
+    self.columns = {name: [] for name in self.schema.names}
+    self.buffered = 0
+
+  def close(self):
+    self.flush()
+    self.writer.close()
+
+
+class Checkpoint:
+  """
+    Ledger of the input files whose rows have been committed, kept in <output>/.checkpoint.
+
+    Each input file's rows go to their own part files, which are committed together with the
+    dedup keys the file added (a delta file per part, merged on resume) once the file is complete.
+    An interrupted run can then resume after the last committed file, and a file that fails is
+    rolled back and listed in <output>/failed_files.txt for a targeted retry. The output tables
+    are compacted from the committed parts at the end of every run.
+    """
+
+  def __init__(self, output_folder, resume=False, key_index=None, schemas=TABLE_SCHEMAS):
+    self.output_folder = output_folder
+    self.key_index = key_index
+    self.schemas = schemas
+    self.folder = os.path.join(output_folder, ".checkpoint")
+    self.ledger_file = os.path.join(self.folder, "ledger.json")
+    self.failed_report = os.path.join(output_folder, "failed_files.txt")
+    if resume and os.path.exists(self.ledger_file):
+      with open(self.ledger_file) as f:
+        self.ledger = json.load(f)
+    else:
+      shutil.rmtree(self.folder, ignore_errors=True)
+      self.ledger = {"id": uuid.uuid4().hex, "parts": 0, "processed": {}, "failed": {}}
+    # Parts of one run must share their columns, so promoted keys cannot change on resume
+    event_columns = self.ledger.setdefault("event_columns", schemas["Event"].names)
+    if event_columns != schemas["Event"].names:
+      raise ValueError(f"The checkpoint in {self.folder} has Event columns {event_columns}; "
+                       f"resume with the same --promote-keys")
+    if key_index:
+      # Keys committed to the index for a part that the ledger never committed
+      key_index.discard(self.tag)
+      key_index.tag = self.tag
+
+    # Part files past the last commit belong to a file whose processing was interrupted
+    for table in TABLE_SCHEMAS:
+      os.makedirs(os.path.join(self.folder, table), exist_ok=True)
+      committed = {self.part_file(table, index) for index in range(self.ledger["parts"])}
+      for name in os.listdir(os.path.join(self.folder, table)):
+        if os.path.join(self.folder, table, name) not in committed:
+          os.remove(os.path.join(self.folder, table, name))
+
+  @property
+  def tag(self):
+    """Key index tag of the part being written."""
+    return f"{self.ledger['id']}:{self.ledger['parts']}"
+
+  def part_file(self, table, index):
+    return os.path.join(self.folder, table, f"part-{index:05d}.parquet")
+
+  def pending(self, json_files, retry_failed=False):
+    """Return the files still to process: the failed ones only with retry_failed."""
+    if retry_failed:
+      return [file_path for file_path in json_files if os.path.abspath(file_path) in self.ledger["failed"]]
+    return [file_path for file_path in json_files if os.path.abspath(file_path) not in self.ledger["processed"]]
+
+  def delta_file(self, index):
+    return os.path.join(self.folder, f"dedup-{index:05d}.pickle")
+
+  def load_seen(self):
+    """Return the dedup sets as of the last commit, merged from the delta of every committed part."""
+    if self.key_index:
+      self.key_index.rollback()
+      return self.key_index.tables()
+    seen = {table: TrackedSet() for table in DEDUP_KEYS}
+    for index in range(self.ledger["parts"]):
+      with open(self.delta_file(index), "rb") as f:
+        for table, keys in pickle.load(f).items():
+          seen[table].update(keys)
+    return seen
+
+  def open_part(self, batch_rows=DEFAULT_BATCH_ROWS):
+    return {table: TableWriter(self.part_file(table, self.ledger["parts"]), schema, batch_rows)
+            for table, schema in self.schemas.items()}
+
+  def discard(self, writers):
+    """Drop the rows written to an uncommitted part."""
+    for writer in writers.values():
+      writer.close()
+      os.remove(writer.out_file)
+
+  def commit(self, file_path, writers, seen, records):
+    """Commit the current part and dedup sets after file_path has been fully processed."""
+    for writer in writers.values():
+      writer.close()
+    index = self.ledger["parts"]
+    if self.key_index:
+      self.key_index.commit()
+    else:
+      # Only the keys this file added, so the checkpoint I/O does not grow with the keys seen so far
+      with open(self.delta_file(index), "wb") as f:
+        pickle.dump({table: keys.added for table, keys in seen.items()}, f, protocol=pickle.HIGHEST_PROTOCOL)
+      for keys in seen.values():
+        keys.added = []
+
+    # The ledger write is the commit point
+    file_path = os.path.abspath(file_path)
+    self.ledger["parts"] = index + 1
+    self.ledger["processed"][file_path] = {"bytes": os.path.getsize(file_path), "records": records, "part": index}
+    self.ledger["failed"].pop(file_path, None)
+    self.save()
+    if self.key_index:
+      self.key_index.tag = self.tag
+
+  def fail(self, file_path, error):
+    # Keep the message on one line for the report
+    self.ledger["failed"][os.path.abspath(file_path)] = f"{type(error).__name__}: {' '.join(str(error).split())}"
+    self.save()
+
+  def save(self):
+    with open(self.ledger_file + ".tmp", "w") as f:
+      json.dump(self.ledger, f, indent=2)
+    os.replace(self.ledger_file + ".tmp", self.ledger_file)
+
+    # Failed files report, one "<path>\t<error>" line per file
+    if self.ledger["failed"]:
+      with open(self.failed_report, "w") as f:
+        for file_path, error in sorted(self.ledger["failed"].items()):
+          f.write(f"{file_path}\t{error}\n")
+    elif os.path.exists(self.failed_report):
+      os.remove(self.failed_report)
+
+  def compact(self, batch_rows=DEFAULT_BATCH_ROWS):
+    """Rewrite the committed parts of each table into its output Parquet file."""
+    for table, schema in self.schemas.items():
+      out_file = os.path.join(self.output_folder, f"{table}.parquet")
+      rows = 0
+      with pq.ParquetWriter(out_file + ".tmp", schema) as writer:
+        pending, pending_rows = [], 0
+        for index in range(self.ledger["parts"]):
+          for batch in pq.ParquetFile(self.part_file(table, index)).iter_batches(batch_size=batch_rows):
+            pending.append(batch)
+            pending_rows += batch.num_rows
+            if pending_rows >= batch_rows:
+              writer.write_table(pa.Table.from_batches(pending, schema))
+              rows += pending_rows
+              pending, pending_rows = [], 0
+        if pending:
+          writer.write_table(pa.Table.from_batches(pending, schema))
+          rows += pending_rows
+      os.replace(out_file + ".tmp", out_file)
+      print(f"Wrote {rows} rows to {out_file}")
+
+
+class TrackedSet(set):
+  """Dedup set that also lists the keys added since the last checkpoint commit."""
+
+  def __init__(self, keys=()):
+    super().__init__(keys)
+    self.added = []
+
+  def add(self, key):
+    super().add(key)
+    self.added.append(key)
+
+
+class KeyIndex:
+  """
+    On-disk (SQLite) index of the natural keys already written, used in place of the in-memory
+    dedup sets so that dedup works across runs without holding every key in RAM: an incremental
+    load only writes the Account, Identity, Session and Resource rows it has not produced before.
+    Keys are added in a transaction that commit() makes durable; each key is tagged so that keys
+    committed for a checkpoint part that never made it into the ledger can be discarded.
+    """
+
+  CACHE_SIZE = 65536
+
+  def __init__(self, index_file):
+    self.conn = sqlite3.connect(index_file)
+    self.conn.execute("CREATE TABLE IF NOT EXISTS keys "
+                      "(tbl TEXT, key TEXT, tag TEXT, PRIMARY KEY (tbl, key)) WITHOUT ROWID")
+    self.conn.commit()
+    self.tag = ""
+    # Keys known to be in the index, so that hot keys skip the SQLite lookup
+    self.cache = set()
+
+  def tables(self):
+    return {table: IndexedKeys(self, table) for table in DEDUP_KEYS}
+
+  def contains(self, table, key):
+    if (table, key) in self.cache:
+      return True
+    found = self.conn.execute("SELECT 1 FROM keys WHERE tbl = ? AND key = ?", (table, key)).fetchone() is not None
+    if found:
+      self.remember(table, key)
+    return found
+
+  def add(self, table, key):
+    self.conn.execute("INSERT OR IGNORE INTO keys VALUES (?, ?, ?)", (table, key, self.tag))
+    self.remember(table, key)
+
+  def remember(self, table, key):
+    if len(self.cache) >= self.CACHE_SIZE:
+      self.cache.clear()
+    self.cache.add((table, key))
+
+  def commit(self):
+    self.conn.commit()
+
+  def rollback(self):
+    """Drop the keys added since the last commit."""
+    self.conn.rollback()
+    self.cache.clear()
+
+  def discard(self, tag):
+    """Drop committed keys carrying tag."""
+    self.conn.execute("DELETE FROM keys WHERE tag = ?", (tag,))
+    self.conn.commit()
+    self.cache.clear()
+
+  def close(self):
+    self.conn.close()
+
+
+class IndexedKeys:
+  """Set-like view of one table's keys in a KeyIndex, supporting the `in` and add() used by the parsers."""
+
+  def __init__(self, index, table):
+    self.index = index
+    self.table = table
+
+  def __contains__(self, key):
+    return self.index.contains(self.table, key)
+
+  def add(self, key):
+    self.index.add(self.table, key)
+
+
+def account_details(account_ids, mode="faker"):
+  """
+    Generate the sample alias, email and phone of every account in one batch, deterministic
+    per account_id. "faker" seeds Faker with each account_id, "hash" derives the details from
+    a hash of the account_id without importing Faker, and "none" leaves them empty.
+    Returns three lists in the order of account_ids.
+    """
+  if mode == "none":
+    return [""] * len(account_ids), [""] * len(account_ids), [""] * len(account_ids)
+  if mode == "faker":
+    # Imported here so that runs without Faker details do not pay for (or need) it
+    from faker import Faker
+    fake = Faker()
+    aliases, emails, phones = [], [], []
+    for account_id in account_ids:
+      fake.seed_instance(account_id)
+      aliases.append(fake.user_name())
+      emails.append(fake.email())
+      phones.append(fake.phone_number())
+    return aliases, emails, phones
+  digests = [int.from_bytes(hashlib.blake2b(str(account_id).encode(), digest_size=8).digest(), "big")
+             for account_id in account_ids]
+  aliases = [f"{FIRST_NAMES[digest % 32]}.{LAST_NAMES[(digest >> 5) % 32]}{(digest >> 10) % 100}" for digest in digests]
+  emails = [f"{alias}@example.com" for alias in aliases]
+  phones = [f"555-{(digest >> 17) % 1000:03d}-{(digest >> 27) % 10000:04d}" for digest in digests]
+  return aliases, emails, phones
+
+
+def enrich_accounts(account_file, mode="faker"):
+  """Fill in the sample details of all accounts in a written Account.parquet (see account_details())."""
+  table = pq.read_table(account_file)
+  aliases, emails, phones = account_details(table["account_id"].to_pylist(), mode)
+  for column, values in (("account_alias", aliases), ("email", emails), ("phone", phones)):
+    table = table.set_column(table.schema.get_field_index(column), column, pa.array(values, pa.string()))
+  pq.write_table(table, account_file + ".tmp")
+  os.replace(account_file + ".tmp", account_file)
+
+
+def generate_session_id(identity_id, creation_date, stable=False):
+  """
+    Generate a simple session_id by concatenating identity_id and creation_date,
+    or a UUID derived from them when stable is set.
+    """
+  if stable:
+    return str(uuid.uuid5(ID_NAMESPACE, f"session:{identity_id}_{creation_date}"))
   return f"{identity_id}_{creation_date}"
 
 
-def generate_resource_id():
-  """Generate a random UUID as resource_id."""
+def generate_resource_id(resource_name=None, stable=False):
+  """
+    Generate a random UUID as resource_id, or with stable a UUID derived from the resource name,
+    so that the same resource gets the same ID in every run, shard and importer.
+    """
+  if stable:
+    return str(uuid.uuid5(ID_NAMESPACE, f"resource:{resource_name}"))
   return str(uuid.uuid4())
 
 
@@ -41,307 +458,692 @@ def safe_get(data, key, default=''):
   return data.get(key) or default
 
 
-def infer_resource_type(request_params):
+# Built-in rules used by infer_resource_type(), in priority order: the first rule that matches wins.
+# A rule matches when every key of one of its "when" alternatives is present in requestParameters.
+# An alternative can also require a key's value to start with a string ("prefix") or to be a list ("list").
+DEFAULT_RESOURCE_RULES = [
+  {"type": "CloudTrailTrail", "when": [
+    {"keys": ["trailNameList"]},
+    {"keys": ["name", "s3BucketName"]},
+    {"keys": ["name", "enableLogFileValidation"]}]},
+  {"type": "S3Bucket", "when": [
+    {"keys": ["bucketName", "CreateBucketConfiguration"]},
+    {"keys": ["bucketName", "bucketPolicy"]},
+    {"keys": ["bucketName", "logging"]},
+    {"keys": ["bucketName", "replication"]},
+    {"keys": ["bucketName", "website"]},
+    {"keys": ["bucketName", "acl"]},
+    {"keys": ["bucketName", "tagging"]},
+    {"keys": ["bucketName", "versioning"]},
+    {"keys": ["bucketName", "policy"], "list": ["policy"]}]},
+  {"type": "EC2Instance", "when": [{"keys": ["instancesSet"]}]},
+  {"type": "AMI", "when": [{"keys": ["imagesSet"]}, {"keys": ["imageId"], "prefix": {"imageId": "ami-"}}]},
+  {"type": "Volume", "when": [{"keys": ["volumeSet"]}, {"keys": ["volumeId"]}]},
+  {"type": "Snapshot", "when": [{"keys": ["snapshotSet"]}, {"keys": ["snapshotId"]}]},
+  {"type": "AvailabilityZone", "when": [{"keys": ["availabilityZoneSet"]}]},
+  {"type": "SecurityGroup", "when": [
+    {"keys": ["securityGroupSet"]}, {"keys": ["securityGroupIdSet"]}, {"keys": ["ipPermissions"]}]},
+  {"type": "Subnet", "when": [{"keys": ["subnetSet"]}, {"keys": ["subnetId"]}]},
+  {"type": "VPC", "when": [{"keys": ["vpcSet"]}, {"keys": ["vpcId"]}]},
+  {"type": "IAMRole", "when": [
+    {"keys": ["roleName", "assumeRolePolicyDocument"]}, {"keys": ["roleName", "policyDocument"]}]},
+  {"type": "IAMPolicy", "when": [{"keys": ["policyName"]}, {"keys": ["policyArn"]}]},
+  {"type": "IAMInstanceProfile", "when": [{"keys": ["instanceProfileName"]}]},
+  {"type": "LambdaFunction", "when": [{"keys": ["functionName", "handler"]}]},
+  {"type": "APIGateway", "when": [{"keys": ["restApiId"]}]},
+  {"type": "CloudFormationStack", "when": [{"keys": ["stackStatusFilter"]}]},
+  {"type": "AWSConfig", "when": [{"keys": ["configurationRecorder"]}, {"keys": ["deliveryChannel"]}]},
+  {"type": "CustomerGateway", "when": [{"keys": ["customerGatewaySet"]}]},
+  {"type": "DHCPOptions", "when": [{"keys": ["dhcpOptionsSet"]}]},
+  {"type": "NetworkAcl", "when": [{"keys": ["networkAclIdSet"]}]},
+  {"type": "ReservedOrSpotInstances", "when": [
+    {"keys": ["reservedInstancesSet"]}, {"keys": ["spotInstanceRequestIdSet"]}]},
+  {"type": "CodeCommit", "when": [{"keys": ["repositoryNames"]}]},
+  {"type": "ACMCertificate", "when": [{"keys": ["certificateStatuses"]}]},
+  {"type": "MFADevice", "when": [{"keys": ["virtualMFADeviceName"]}, {"keys": ["serialNumber"]}]},
+  # Generic query: keys like maxResults, filterSet, nextToken, pageSize or limit exist
+  {"type": "GenericQuery", "when": [
+    {"keys": ["maxResults"]}, {"keys": ["nextToken"]}, {"keys": ["filterSet"]}, {"keys": ["pageSize"]},
+    {"keys": ["limit"]}]},
+]
+
+
+class ResourceTypeRules:
+  """
+    Resource type rules compiled into an index from trigger key to the rule alternatives that
+    key can satisfy, so a record only looks up its own requestParameters keys once instead of
+    walking every rule. Results are cached per key set, since the same API call always sends
+    the same requestParameters keys; records with keys whose values a rule inspects bypass the cache.
+    """
+
+  CACHE_SIZE = 65536
+
+  def __init__(self, rules):
+    self.index = {}
+    self.cache = {}
+    self.value_keys = set()
+    for priority, rule in enumerate(rules):
+      for condition in rule["when"]:
+        trigger, *other_keys = condition["keys"]
+        self.index.setdefault(trigger, []).append(
+          (priority, rule["type"], other_keys, condition.get("prefix", {}), condition.get("list", [])))
+        self.value_keys.update(condition.get("prefix", {}), condition.get("list", []))
+    for alternatives in self.index.values():
+      alternatives.sort(key=lambda alternative: alternative[0])
+
+  @classmethod
+  def from_file(cls, rules_file):
+    """
+      Load rules from a JSON file; they take precedence over the built-in rules. Raises ValueError
+      naming the first rule without a type or with a condition whose keys list is empty.
+      """
+    with open(rules_file) as f:
+      rules = json.load(f)
+    if not isinstance(rules, list):
+      raise ValueError(f"{rules_file} must hold a JSON list of resource type rules")
+    for number, rule in enumerate(rules, 1):
+      if not (isinstance(rule, dict) and rule.get("type") and isinstance(rule.get("when"), list) and rule["when"]
+              and all(isinstance(condition, dict) and condition.get("keys") for condition in rule["when"])):
+        raise ValueError(f"Resource type rule #{number} in {rules_file} needs a type and a non-empty "
+                         f"\"keys\" list in each \"when\" condition: {json.dumps(rule)}")
+    return cls(rules + DEFAULT_RESOURCE_RULES)
+
+  def infer(self, request_params):
+    if not self.value_keys.isdisjoint(request_params):
+      return self.match(request_params)
+    keys = tuple(request_params)
+    resource_type = self.cache.get(keys)
+    if resource_type is None:
+      if len(self.cache) >= self.CACHE_SIZE:
+        self.cache.clear()
+      resource_type = self.cache[keys] = self.match(request_params)
+    return resource_type
+
+  def match(self, request_params):
+    best_priority, best_type = None, ''
+    for key in request_params:
+      for priority, resource_type, other_keys, prefixes, list_keys in self.index.get(key, ()):
+        if best_priority is not None and priority >= best_priority:
+          break
+        if (all(other in request_params for other in other_keys)
+                and all(isinstance(request_params.get(k), str) and request_params[k].startswith(prefix)
+                        for k, prefix in prefixes.items())
+                and all(isinstance(request_params.get(k), list) for k in list_keys)):
+          best_priority, best_type = priority, resource_type
+          break
+    return best_type
+
+
+RESOURCE_RULES = ResourceTypeRules(DEFAULT_RESOURCE_RULES)
+
+
+def infer_resource_type(request_params, rules=None):
   """
-    Infer a resource type string based on keys in requestParameters.
+    Infer a resource type string based on keys in requestParameters, using the built-in
+    rules unless rules (a ResourceTypeRules) is given.
     Returns a tuple: (resource_type, extra_metadata).
     """
   if not request_params:
     return '', {}
+  return (rules or RESOURCE_RULES).infer(request_params), {}
 
-  # CloudTrail Trail
-  if 'trailNameList' in request_params or ('name' in request_params and (
-          's3BucketName' in request_params or 'enableLogFileValidation' in request_params)):
-    return 'CloudTrailTrail', {}
-
-  # S3 Bucket related requests
-  if 'bucketName' in request_params and (
-          'CreateBucketConfiguration' in request_params or
-          'bucketPolicy' in request_params or
-          'logging' in request_params or
-          'replication' in request_params or
-          'website' in request_params or
-          'acl' in request_params or
-          'tagging' in request_params or
-          'versioning' in request_params or
-          ('policy' in request_params and isinstance(request_params.get('policy'), list))):
-    return 'S3Bucket', {}
-
-  # EC2 Instance related
-  if 'instancesSet' in request_params:
-    return 'EC2Instance', {}
-
-  # AMI / Images
-  if 'imagesSet' in request_params or (
-          'imageId' in request_params and request_params.get('imageId', '').startswith('ami-')):
-    return 'AMI', {}
-
-  # Volume related
-  if 'volumeSet' in request_params or 'volumeId' in request_params:
-    return 'Volume', {}
-
-  # Snapshot related
-  if 'snapshotSet' in request_params or 'snapshotId' in request_params:
-    return 'Snapshot', {}
-
-  # Availability Zone
-  if 'availabilityZoneSet' in request_params:
-    return 'AvailabilityZone', {}
-
-  # Security Group
-  if 'securityGroupSet' in request_params or 'securityGroupIdSet' in request_params or 'ipPermissions' in request_params:
-    return 'SecurityGroup', {}
-
-  # Subnet
-  if 'subnetSet' in request_params or 'subnetId' in request_params:
-    return 'Subnet', {}
-
-  # VPC
-  if 'vpcSet' in request_params or 'vpcId' in request_params:
-    return 'VPC', {}
-
-  # IAM Role related
-  if 'roleName' in request_params and (
-          'assumeRolePolicyDocument' in request_params or 'policyDocument' in request_params):
-    return 'IAMRole', {}
-
-  # IAM Policy related
-  if 'policyName' in request_params or 'policyArn' in request_params:
-    return 'IAMPolicy', {}
-
-  # Instance Profile
-  if 'instanceProfileName' in request_params:
-    return 'IAMInstanceProfile', {}
-
-  # Lambda Function
-  if 'functionName' in request_params and 'handler' in request_params:
-    return 'LambdaFunction', {}
-
-  # API Gateway related (could be refined further)
-  if 'restApiId' in request_params:
-    return 'APIGateway', {}
-
-  # CloudFormation Stack
-  if 'stackStatusFilter' in request_params:
-    return 'CloudFormationStack', {}
-
-  # AWS Config / configuration recorder
-  if 'configurationRecorder' in request_params or 'deliveryChannel' in request_params:
-    return 'AWSConfig', {}
-
-  # Network related resources
-  if 'customerGatewaySet' in request_params:
-    return 'CustomerGateway', {}
-  if 'dhcpOptionsSet' in request_params:
-    return 'DHCPOptions', {}
-  if 'networkAclIdSet' in request_params:
-    return 'NetworkAcl', {}
-
-  # Reserved Instances or Spot Instance Requests
-  if 'reservedInstancesSet' in request_params or 'spotInstanceRequestIdSet' in request_params:
-    return 'ReservedOrSpotInstances', {}
-
-  # CodeCommit repository
-  if 'repositoryNames' in request_params:
-    return 'CodeCommit', {}
-
-  # ACM Certificate
-  if 'certificateStatuses' in request_params:
-    return 'ACMCertificate', {}
-
-  # MFA Device
-  if 'virtualMFADeviceName' in request_params or 'serialNumber' in request_params:
-    return 'MFADevice', {}
 
-  # Generic query: keys like maxResults, filterSet, nextToken, pageSize or limit exist
-  if any(k in request_params for k in ['maxResults', 'nextToken', 'filterSet', 'pageSize', 'limit']):
-    return 'GenericQuery', {}
+def benchmark_resource_rules(json_files, rules=None, max_records=100000, repeat=5):
+  """
+    Micro-benchmark infer_resource_type() over the requestParameters of a sample trail,
+    with and without the per key set cache, and print the resulting resource type counts.
+    """
+  rules = rules or RESOURCE_RULES
+  samples = []
+  for file_path in json_files:
+    with open_json(file_path) as f:
+      for record in ijson.items(f, "Records.item"):
+        samples.append(record.get("requestParameters") or {})
+        if len(samples) >= max_records:
+          break
+    if len(samples) >= max_records:
+      break
+  print(f"Benchmarking resource type rules over {len(samples)} records from {len(json_files)} file(s).")
+
+  for label, infer in (("index only", rules.match), ("index + cache", rules.infer)):
+    rules.cache.clear()
+    start = time.perf_counter()
+    for _ in range(repeat):
+      for request_params in samples:
+        if request_params:
+          infer(request_params)
+    elapsed = time.perf_counter() - start
+    print(f"  {label:<14} {len(samples) * repeat / elapsed:>12.0f} records/s "
+          f"({elapsed / (len(samples) * repeat) * 1e6:.2f} us/record)")
 
-  # Default: return an empty type
-  return '', {}
+  counts = {}
+  for request_params in samples:
+    resource_type = infer_resource_type(request_params, rules)[0] or "(none)"
+    counts[resource_type] = counts.get(resource_type, 0) + 1
+  for resource_type, count in sorted(counts.items(), key=lambda item: -item[1]):
+    print(f"  {resource_type:<24} {count:>8}")
 
 
-def process_files(input_folder, output_folder):
+def log_file_date(file_path):
+  """Return the delivery date from the YYYY/MM/DD path components or the file name, or None."""
+  match = (DATE_PATH_PATTERN.search(file_path.replace(os.sep, "/"))
+           or DATE_NAME_PATTERN.search(os.path.basename(file_path)))
+  if not match:
+    return None
+  try:
+    return datetime.date(*(int(part) for part in match.groups()))
+  except ValueError:
+    return None
+
+
+def discover_files(input_path, since=None, until=None, exclude=None):
+  """
+    Return the sorted .json and .json.gz files under input_path, searched recursively.
+    With since/until (inclusive dates) only files whose delivery date is in range are kept;
+    files without a date in their path are then skipped. The folder exclude (the output folder,
+    with its .checkpoint ledger) and everything under it is not searched.
+    """
+  if os.path.isfile(input_path):
+    candidates = [input_path]
+  else:
+    excluded = os.path.realpath(exclude) if exclude else None
+    candidates = []
+    for root, dirs, names in os.walk(input_path):
+      dirs[:] = [name for name in dirs if os.path.realpath(os.path.join(root, name)) != excluded]
+      candidates.extend(os.path.join(root, name) for name in names if name.lower().endswith(('.json', '.json.gz')))
+
+  json_files = []
+  for file_path in sorted(candidates):
+    if since or until:
+      file_date = log_file_date(os.path.relpath(file_path, input_path) if os.path.isdir(input_path) else file_path)
+      if file_date is None or (since and file_date < since) or (until and file_date > until):
+        continue
+    json_files.append(file_path)
+  return json_files
+
+
+def open_json(file_path):
+  """Open a log file for ijson, decompressing .gz files on the fly."""
+  if file_path.lower().endswith('.gz'):
+    return gzip.open(file_path, 'rb')
+  return open(file_path, 'rb')
+
+
+def iter_raw_records(f, chunk_size=RAW_CHUNK_BYTES):
+  """
+    Yield (record, raw) for each item of the top-level "Records" array of a binary file, where raw
+    maps each non-empty RAW_FIELDS value of the record to its original JSON text. Whole records
+    are decoded by the json module's C scanner from a sliding text buffer, so the raw text can
+    be sliced from the buffer instead of re-encoding the decoded value. The raw text keeps
+    numbers as written, where re-encoding turns ijson's Decimals into strings.
+    """
+  decoder = codecs.getincrementaldecoder("utf-8")()
+  # Decimal floats, as ijson produces, so the other columns match the default reader
+  scan = json.JSONDecoder(parse_float=decimal.Decimal).scan_once
+  text, pos, eof = "", 0, False
+
+  def read_more():
+    nonlocal text, pos, eof
+    chunk = f.read(chunk_size)
+    eof = not chunk
+    text = text[pos:] + decoder.decode(chunk, final=eof)
+    pos = 0
+
+  # Skip to the opening bracket of the Records array
+  match = RECORDS_PATTERN.search(text)
+  while match is None:
+    if eof:
+      raise ValueError('No top-level "Records" array found')
+    read_more()
+    match = RECORDS_PATTERN.search(text)
+  pos = match.end()
+
+  while True:
+    try:
+      pos = SEPARATOR_PATTERN.match(text, pos).end()
+      if text[pos] == "]":
+        return
+      record, end = scan(text, pos)
+    except (StopIteration, ValueError, IndexError):
+      # The buffer ends inside the record: read on, unless the file itself is truncated
+      if eof:
+        raise ValueError("Malformed or truncated Records array")
+      read_more()
+      continue
+    raw = {}
+    for key in RAW_FIELDS:
+      if record.get(key):
+        span = raw_span(text, pos, end, key, record[key], scan)
+        if span is not None:
+          raw[key] = span
+    yield record, raw
+    pos = end
+
+
+def raw_span(text, start, end, key, value, scan):
+  """
+    Return the JSON text of the "key" member of the object in text[start:end], or None if it
+    cannot be found. A candidate is only accepted if it decodes back to value, so a match
+    inside a nested string or object can never change the output.
+    """
+  marker = f'"{key}"'
+  index = text.find(marker, start, end)
+  while index != -1:
+    pos = WHITESPACE_PATTERN.match(text, index + len(marker)).end()
+    if text[pos] == ":":
+      pos = WHITESPACE_PATTERN.match(text, pos + 1).end()
+      try:
+        candidate, candidate_end = scan(text, pos)
+        if candidate == value:
+          return text[pos:candidate_end]
+      except (StopIteration, ValueError):
+        pass
+    index = text.find(marker, index + 1, end)
+  return None
+
+
+def parse_promoted_keys(specs):
   """
-    Process all JSON files in the input folder (each should have a top-level "Records" array),
+    Turn "key" or "key:type" specs into (key, column, type) tuples. The column is the key in
+    snake case with a request_ prefix, e.g. bucketName becomes request_bucket_name.
+    """
+  promoted = []
+  for spec in specs:
+    key, _, type_name = spec.partition(":")
+    type_name = type_name or "string"
+    if type_name not in PROMOTED_TYPES:
+      raise ValueError(f"Unsupported type {type_name!r} for promoted key {key!r}; use one of {', '.join(PROMOTED_TYPES)}")
+    column = "request_" + re.sub(r"(?<=[a-z0-9])(?=[A-Z])", "_", key).lower()
+    promoted.append((key, column, type_name))
+  return promoted
+
+
+def promote_value(value, type_name):
+  """Return value as the promoted column type, or None when its JSON type does not match."""
+  if type_name == "string":
+    return value if isinstance(value, str) else None
+  if type_name == "bool":
+    return value if isinstance(value, bool) else None
+  if isinstance(value, bool) or not isinstance(value, (int, float, decimal.Decimal)):
+    return None
+  if type_name == "int64":
+    return int(value) if value == int(value) else None
+  return float(value)
+
+
+def table_schemas(promoted=None):
+  """Return TABLE_SCHEMAS with a column per promoted request parameter appended to Event."""
+  if not promoted:
+    return TABLE_SCHEMAS
+  schemas = dict(TABLE_SCHEMAS)
+  schemas["Event"] = pa.schema(list(TABLE_SCHEMAS["Event"]) +
+                               [pa.field(column, PROMOTED_TYPES[type_name]) for _, column, type_name in promoted])
+  return schemas
+
+
+def parse_file(file_path, tables, seen, deferred=False, rules=None, stable_ids=False, raw_params=False,
+               promoted=None):
+  """
+    Parse one JSON file with a top-level "Records" array and append the rows it contributes
+    to each table. Rows whose natural key is already in seen are skipped. With stable_ids the
+    session and resource IDs are derived from their natural keys (see generate_resource_id()).
+
+    With raw_params the request and response parameters are copied from the file text
+    (see iter_raw_records()) instead of being re-encoded, and promoted (from parse_promoted_keys())
+    adds the listed requestParameters keys to each Event row as typed columns.
+
+    Account details are left empty for enrich_accounts(). With deferred=True the resource IDs
+    are left empty too, to be filled in by merge_shard() in the same order as a serial run.
+    """
+  accounts_rows = tables["Account"]
+  identity_rows = tables["Identity"]
+  session_rows = tables["Session"]
+  event_rows = tables["Event"]
+  resource_rows = tables["Resource"]
+  event_resource_rows = tables["EventResource"]
+
+  # Deduplication sets based on natural keys
+  accounts_set = seen["Account"]
+  identities_set = seen["Identity"]
+  sessions_set = seen["Session"]
+  resources_set = seen["Resource"]  # use natural resource name as key
+
+  records = 0
+  with open_json(file_path) as f:
+    if raw_params:
+      items = iter_raw_records(f)
+    else:
+      items = ((record, None) for record in ijson.items(f, "Records.item"))
+    for record, raw in items:
+      records += 1
+      # Process Account table
+      user_identity = record.get("userIdentity") or {}
+      account_id = safe_get(user_identity, "accountId")
+      if account_id and account_id not in accounts_set:
+        accounts_set.add(account_id)
+        accounts_rows.append({
+          "account_id": str(account_id),  # Ensure account_id is stored as string
+          "account_alias": "",
+          "email": "",
+          "phone": ""
+        })
+
+      # Process Identity table
+      identity_id = safe_get(user_identity, "arn")
+      if identity_id and identity_id not in identities_set:
+        identities_set.add(identity_id)
+        identity_rows.append({
+          "identity_id": identity_id,
+          "type": safe_get(user_identity, "type"),
+          "principal_id": safe_get(user_identity, "principalId"),
+          "arn": identity_id,
+          "user_name": safe_get(user_identity, "userName"),
+          "account_id": str(account_id)
+        })
+
+      # Process Session table
+      session_context = record.get("userIdentity", {}).get("sessionContext", {}) or {}
+      attributes = session_context.get("attributes", {}) or {}
+      creation_date = safe_get(attributes, "creationDate")
+      if creation_date:
+        session_id = generate_session_id(identity_id, creation_date, stable_ids)
+        if session_id not in sessions_set:
+          sessions_set.add(session_id)
+          additional_info = {
+            "sessionIssuer": session_context.get("sessionIssuer", {}),
+            "webIdFederationData": session_context.get("webIdFederationData", {})
+          }
+          session_rows.append({
+            "session_id": session_id,
+            "creation_date": creation_date,
+            "mfa_authenticated": str(safe_get(attributes, "mfaAuthenticated", "false")).lower() == "true",
+            "additional_info": safe_json_dumps(additional_info),
+            "identity_id": identity_id
+          })
+      else:
+        session_id = ""
+
+      # Process Event table
+      event_id = safe_get(record, "eventID")
+      event_time = safe_get(record, "eventTime")
+      event_source = safe_get(record, "eventSource")
+      event_name = safe_get(record, "eventName")
+      source_ip = safe_get(record, "sourceIPAddress")
+      user_agent = safe_get(record, "userAgent")
+      request_params_raw = record.get("requestParameters") or {}
+      response_params_raw = record.get("responseElements") or {}
+      event_row = {
+        "event_id": event_id,
+        "event_time": event_time,
+        "event_source": event_source,
+        "event_name": event_name,
+        "source_ip": source_ip,
+        "user_agent": user_agent,
+        "request_params": (raw and raw.get("requestParameters")) or safe_json_dumps(request_params_raw),
+        "response_params": (raw and raw.get("responseElements")) or safe_json_dumps(response_params_raw),
+        "identity_id": identity_id,
+        "session_id": session_id,
+        "account_id": str(account_id)
+      }
+      if promoted:
+        request_params = request_params_raw if isinstance(request_params_raw, dict) else {}
+        for key, column, type_name in promoted:
+          event_row[column] = promote_value(request_params.get(key), type_name)
+      event_rows.append(event_row)
+
+      # Process Resource from responseElements.instancesSet (for EC2 instance events)
+      response_elements = record.get("responseElements") or {}
+      instances_set = response_elements.get("instancesSet", {}) or {}
+      items = instances_set.get("items", []) or []
+      for item in items:
+        # Prefer resource info from response; assume instanceId is provided as natural name
+        natural_name = safe_get(item, "instanceId")
+        if natural_name and natural_name not in resources_set:
+          resources_set.add(natural_name)
+          generated_resource_id = "" if deferred else generate_resource_id(natural_name, stable_ids)
+          resource_rows.append({
+            "resource_id": generated_resource_id,
+            "resource_name": natural_name,
+            "resource_type": "EC2Instance",
+            "additional_metadata": safe_json_dumps(item)
+          })
+          event_resource_rows.append({
+            "event_id": event_id,
+            "resource_id": generated_resource_id,
+            "pre_state": safe_get(item.get("previousState"), "name"),
+            "post_state": safe_get(item.get("currentState"), "name")
+          })
+
+      # Process Resource inferred from requestParameters as fallback
+      resource_type, extra_metadata = infer_resource_type(request_params_raw, rules)
+      if resource_type:
+        # Determine natural name using common keys ("name", "bucketName", "instanceId")
+        natural_name = safe_get(request_params_raw, "name")
+        if not natural_name:
+          natural_name = safe_get(request_params_raw, "bucketName")
+        if not natural_name:
+          natural_name = safe_get(request_params_raw, "instanceId")
+        if natural_name and natural_name not in resources_set:
+          resources_set.add(natural_name)
+          generated_resource_id = "" if deferred else generate_resource_id(natural_name, stable_ids)
+          resource_rows.append({
+            "resource_id": generated_resource_id,
+            "resource_name": natural_name,
+            "resource_type": resource_type,
+            "additional_metadata": safe_json_dumps(extra_metadata)
+          })
+          event_resource_rows.append({
+            "event_id": event_id,
+            "resource_id": generated_resource_id,
+            "pre_state": "",
+            "post_state": ""
+          })
+  return records
+
+
+def parse_shard(file_path, shard_folder, batch_rows=DEFAULT_BATCH_ROWS, rules=None, stable_ids=False,
+                raw_params=False, promoted=None):
+  """
+    Worker entry point for parallel mode: parse one file into its own set of table shards,
+    deduplicated within the file only. Returns the shard folder, the number of records parsed
+    and the error that stopped parsing, if any.
+    """
+  os.makedirs(shard_folder, exist_ok=True)
+  writers = open_writers(shard_folder, batch_rows, table_schemas(promoted))
+  records, error = 0, None
+  try:
+    records = parse_file(file_path, writers, {table: set() for table in DEDUP_KEYS}, deferred=True, rules=rules,
+                         stable_ids=stable_ids, raw_params=raw_params, promoted=promoted)
+  except Exception as e:
+    # Keep the rows parsed before the error, as a serial run does
+    print(f"Error processing file {file_path}: {e}")
+    error = e
+  finally:
+    for writer in writers.values():
+      writer.close()
+  return shard_folder, records, error
+
+
+def merge_shard(shard_folder, writers, seen, batch_rows=DEFAULT_BATCH_ROWS, stable_ids=False):
+  """
+    Append one file's shards to the output tables, dropping rows whose natural key was already
+    produced by an earlier file and filling in the deferred resource IDs.
+    """
+  def read_rows(table):
+    shard = pq.ParquetFile(os.path.join(shard_folder, f"{table}.parquet"))
+    for batch in shard.iter_batches(batch_size=batch_rows):
+      yield from batch.to_pylist()
+
+  for row in read_rows("Account"):
+    if row["account_id"] not in seen["Account"]:
+      seen["Account"].add(row["account_id"])
+      writers["Account"].append(row)
+
+  for table in ("Identity", "Session"):
+    key = DEDUP_KEYS[table]
+    for row in read_rows(table):
+      if row[key] not in seen[table]:
+        seen[table].add(row[key])
+        writers[table].append(row)
+
+  # Events are never deduplicated, so they are copied batch by batch
+  for batch in pq.ParquetFile(os.path.join(shard_folder, "Event.parquet")).iter_batches(batch_size=batch_rows):
+    writers["Event"].write_batch(batch)
+
+  # Each new resource produced exactly one EventResource row, so the two shards line up
+  for resource_row, event_resource_row in zip(read_rows("Resource"), read_rows("EventResource")):
+    if resource_row["resource_name"] not in seen["Resource"]:
+      seen["Resource"].add(resource_row["resource_name"])
+      resource_row["resource_id"] = event_resource_row["resource_id"] = generate_resource_id(
+        resource_row["resource_name"], stable_ids)
+      writers["Resource"].append(resource_row)
+      writers["EventResource"].append(event_resource_row)
+
+
+def open_writers(folder, batch_rows=DEFAULT_BATCH_ROWS, schemas=TABLE_SCHEMAS):
+  """Open one buffered Parquet writer per table in folder."""
+  return {table: TableWriter(os.path.join(folder, f"{table}.parquet"), schema, batch_rows)
+          for table, schema in schemas.items()}
+
+
+def process_files(input_path, output_folder, *, batch_rows=DEFAULT_BATCH_ROWS, workers=1, since=None, until=None,
+                  rules=None, checkpoint=False, resume=False, retry_failed=False, stable_ids=False,
+                  key_index_file=None, raw_params=False, promoted=None, account_details_mode="faker"):
+  """
+    Process a JSON file, or all .json and .json.gz files found recursively under a folder
+    (each should have a top-level "Records" array), optionally limited to the logs delivered
+    between since and until,
     extract data for Account, Identity, Session, Event, Resource, and EventResource tables,
-    and then write each table to a Parquet file in the output folder.
+    and stream each table to a Parquet file in the output folder.
 
     The output files are: Account.parquet, Identity.parquet, Session.parquet,
     Event.parquet, Resource.parquet, EventResource.parquet.
+
+    Rows are flushed as a row group whenever a table has buffered batch_rows rows,
+    so only the deduplication sets grow with the size of the input.
+
+    With workers > 1 the files are parsed in a process pool into per-file shards, which are
+    merged in file order so that the output matches a serial run.
+
+    With checkpoint, progress is committed after every file (see Checkpoint); resume continues
+    from the last committed file and retry_failed processes only the files that failed before.
+
+    With stable_ids, session and resource IDs are derived from their natural keys instead of
+    being random. key_index_file keeps the dedup keys in an on-disk KeyIndex shared across runs
+    (and implies stable_ids, so that later runs reference the resources written by earlier ones);
+    each run then writes only its new rows, so it refuses an output folder that already holds tables.
+
+    raw_params and promoted are passed on to parse_file(). The sample account details are
+    added in one batch once the tables are written, as set by account_details_mode.
     """
   # Create output folder if it doesn't exist
   if not os.path.exists(output_folder):
     os.makedirs(output_folder)
 
-  # Lists to accumulate rows for each table
-  accounts_rows = []
-  identity_rows = []
-  session_rows = []
-  event_rows = []
-  resource_rows = []
-  event_resource_rows = []
+  # Find the JSON files to process (.json or gzip-compressed .json.gz)
+  json_files = discover_files(input_path, since, until, exclude=output_folder)
+  total_files = len(json_files)
+  print(f"Found {total_files} JSON file(s) in {input_path}.")
 
-  # Deduplication sets based on natural keys
-  accounts_set = set()
-  identities_set = set()
-  sessions_set = set()
-  resources_set = set()  # use natural resource name as key
+  # The key index records rows written by earlier runs, so their tables must not be overwritten
+  # (a resumed checkpoint rebuilds them from all of its parts)
+  resuming = (resume or retry_failed) and os.path.exists(os.path.join(output_folder, ".checkpoint", "ledger.json"))
+  if key_index_file and not resuming:
+    existing = [table for table in TABLE_SCHEMAS if os.path.exists(os.path.join(output_folder, f"{table}.parquet"))]
+    if existing:
+      print(f"{output_folder} already holds {', '.join(existing)} tables written by an earlier run; with "
+            f"--key-index, write each run to a new output folder and append its tables to the previous ones.")
+      return
 
-  # Process each JSON file in the input folder (files with .json extension)
-  json_files = [f for f in os.listdir(input_folder) if f.lower().endswith('.json')]
-  total_files = len(json_files)
-  print(f"Found {total_files} JSON file(s) in {input_folder}.")
+  key_index = KeyIndex(key_index_file) if key_index_file else None
+  stable_ids = stable_ids or key_index is not None
+  schemas = table_schemas(promoted)
 
-  for json_file in json_files:
-    file_path = os.path.join(input_folder, json_file)
-    print(f"Processing file: {file_path}")
-    try:
-      with open(file_path, 'r', encoding='utf-8') as f:
-        for record in ijson.items(f, "Records.item"):
-          # Process Account table
-          user_identity = record.get("userIdentity") or {}
-          account_id = safe_get(user_identity, "accountId")
-          if account_id and account_id not in accounts_set:
-            accounts_set.add(account_id)
-            accounts_rows.append({
-              "account_id": str(account_id),  # Ensure account_id is stored as string
-              "account_alias": fake.user_name(),
-              "email": fake.email(),
-              "phone": fake.phone_number()
-            })
-
-          # Process Identity table
-          identity_id = safe_get(user_identity, "arn")
-          if identity_id and identity_id not in identities_set:
-            identities_set.add(identity_id)
-            identity_rows.append({
-              "identity_id": identity_id,
-              "type": safe_get(user_identity, "type"),
-              "principal_id": safe_get(user_identity, "principalId"),
-              "arn": identity_id,
-              "user_name": safe_get(user_identity, "userName"),
-              "account_id": str(account_id)
-            })
-
-          # Process Session table
-          session_context = record.get("userIdentity", {}).get("sessionContext", {}) or {}
-          attributes = session_context.get("attributes", {}) or {}
-          creation_date = safe_get(attributes, "creationDate")
-          if creation_date:
-            session_id = generate_session_id(identity_id, creation_date)
-            if session_id not in sessions_set:
-              sessions_set.add(session_id)
-              additional_info = {
-                "sessionIssuer": session_context.get("sessionIssuer", {}),
-                "webIdFederationData": session_context.get("webIdFederationData", {})
-              }
-              session_rows.append({
-                "session_id": session_id,
-                "creation_date": creation_date,
-                "mfa_authenticated": str(safe_get(attributes, "mfaAuthenticated", "false")).lower() == "true",
-                "additional_info": safe_json_dumps(additional_info),
-                "identity_id": identity_id
-              })
-          else:
-            session_id = ""
-
-          # Process Event table
-          event_id = safe_get(record, "eventID")
-          event_time = safe_get(record, "eventTime")
-          event_source = safe_get(record, "eventSource")
-          event_name = safe_get(record, "eventName")
-          source_ip = safe_get(record, "sourceIPAddress")
-          user_agent = safe_get(record, "userAgent")
-          request_params_raw = record.get("requestParameters") or {}
-          response_params_raw = record.get("responseElements") or {}
-          event_rows.append({
-            "event_id": event_id,
-            "event_time": event_time,
-            "event_source": event_source,
-            "event_name": event_name,
-            "source_ip": source_ip,
-            "user_agent": user_agent,
-            "request_params": safe_json_dumps(request_params_raw),
-            "response_params": safe_json_dumps(response_params_raw),
-            "identity_id": identity_id,
-            "session_id": session_id,
-            "account_id": str(account_id)
-          })
+  if checkpoint or resume or retry_failed:
+    ledger = Checkpoint(output_folder, resume=resume or retry_failed, key_index=key_index, schemas=schemas)
+    json_files = ledger.pending(json_files, retry_failed)
+    print(f"{total_files - len(json_files)} file(s) already committed or skipped, {len(json_files)} to process.")
+    seen = ledger.load_seen()
+    writers = ledger.open_part(batch_rows)
+  else:
+    # One buffered Parquet writer per table, and deduplication sets based on natural keys
+    ledger = None
+    seen = key_index.tables() if key_index else {table: set() for table in DEDUP_KEYS}
+    writers = open_writers(output_folder, batch_rows, schemas)
 
-          # Process Resource from responseElements.instancesSet (for EC2 instance events)
-          response_elements = record.get("responseElements") or {}
-          instances_set = response_elements.get("instancesSet", {}) or {}
-          items = instances_set.get("items", []) or []
-          for item in items:
-            # Prefer resource info from response; assume instanceId is provided as natural name
-            natural_name = safe_get(item, "instanceId")
-            if natural_name and natural_name not in resources_set:
-              resources_set.add(natural_name)
-              generated_resource_id = generate_resource_id()
-              resource_rows.append({
-                "resource_id": generated_resource_id,
-                "resource_name": natural_name,
-                "resource_type": "EC2Instance",
-                "additional_metadata": safe_json_dumps(item)
-              })
-              event_resource_rows.append({
-                "event_id": event_id,
-                "resource_id": generated_resource_id,
-                "pre_state": safe_get(item.get("previousState"), "name"),
-                "post_state": safe_get(item.get("currentState"), "name")
-              })
-
-          # Process Resource inferred from requestParameters as fallback
-          resource_type, extra_metadata = infer_resource_type(request_params_raw)
-          if resource_type:
-            # Determine natural name using common keys ("name", "bucketName", "instanceId")
-            natural_name = safe_get(request_params_raw, "name")
-            if not natural_name:
-              natural_name = safe_get(request_params_raw, "bucketName")
-            if not natural_name:
-              natural_name = safe_get(request_params_raw, "instanceId")
-            if natural_name and natural_name not in resources_set:
-              resources_set.add(natural_name)
-              generated_resource_id = generate_resource_id()
-              resource_rows.append({
-                "resource_id": generated_resource_id,
-                "resource_name": natural_name,
-                "resource_type": resource_type,
-                "additional_metadata": safe_json_dumps(extra_metadata)
-              })
-              event_resource_rows.append({
-                "event_id": event_id,
-                "resource_id": generated_resource_id,
-                "pre_state": "",
-                "post_state": ""
-              })
-    except Exception as e:
-      print(f"Error processing file {file_path}: {e}")
-
-  # After processing all files, convert lists to DataFrames and write to Parquet files
-  def write_parquet(data_rows, out_file):
-    try:
-      df = pd.DataFrame(data_rows)
-      df.to_parquet(out_file, engine='pyarrow', index=False)
-      print(f"Wrote {len(data_rows)} rows to {out_file}")
-    except Exception as e:
-      print(f"Error writing {out_file}: {e}")
-
-  # Define output file paths for each table
-  out_account = os.path.join(output_folder, "Account.parquet")
-  out_identity = os.path.join(output_folder, "Identity.parquet")
-  out_session = os.path.join(output_folder, "Session.parquet")
-  out_event = os.path.join(output_folder, "Event.parquet")
-  out_resource = os.path.join(output_folder, "Resource.parquet")
-  out_event_resource = os.path.join(output_folder, "EventResource.parquet")
-
-  write_parquet(accounts_rows, out_account)
-  write_parquet(identity_rows, out_identity)
-  write_parquet(session_rows, out_session)
-  write_parquet(event_rows, out_event)
-  write_parquet(resource_rows, out_resource)
-  write_parquet(event_resource_rows, out_event_resource)
+  if workers > 1:
+    shard_root = os.path.join(output_folder, ".shards")
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+      def submit(index):
+        return json_files[index], executor.submit(parse_shard, json_files[index],
+                                                  os.path.join(shard_root, str(index)), batch_rows, rules,
+                                                  stable_ids, raw_params, promoted)
+
+      # Keep a window of about two files per worker in flight, so that the shards finished behind
+      # a slow file do not pile up on disk
+      window = min(2 * workers, len(json_files))
+      futures = collections.deque(submit(index) for index in range(window))
+      next_index = window
+      # Merge in file order so that first-seen rows and generated IDs match a serial run
+      while futures:
+        file_path, future = futures.popleft()
+        if next_index < len(json_files):
+          futures.append(submit(next_index))
+          next_index += 1
+        shard_folder, records, error = future.result()
+        if error and ledger:
+          # Leave the failed file out entirely so that it can be retried on its own
+          ledger.fail(file_path, error)
+        else:
+          print(f"Merging file: {file_path}")
+          merge_shard(shard_folder, writers, seen, batch_rows, stable_ids)
+          if ledger:
+            ledger.commit(file_path, writers, seen, records)
+            writers = ledger.open_part(batch_rows)
+        shutil.rmtree(shard_folder)
+    shutil.rmtree(shard_root, ignore_errors=True)
+  else:
+    for file_path in json_files:
+      print(f"Processing file: {file_path}")
+      try:
+        records = parse_file(file_path, writers, seen, rules=rules, stable_ids=stable_ids, raw_params=raw_params,
+                             promoted=promoted)
+      except Exception as e:
+        print(f"Error processing file {file_path}: {e}")
+        if ledger:
+          # Roll back the rows and dedup keys of the failed file
+          ledger.discard(writers)
+          ledger.fail(file_path, e)
+          seen = ledger.load_seen()
+          writers = ledger.open_part(batch_rows)
+        continue
+      if ledger:
+        ledger.commit(file_path, writers, seen, records)
+        writers = ledger.open_part(batch_rows)
+
+  if ledger:
+    # Build the output tables from every committed part
+    ledger.discard(writers)
+    ledger.compact(batch_rows)
+    if ledger.ledger["failed"]:
+      print(f"{len(ledger.ledger['failed'])} file(s) failed, see {ledger.failed_report}; "
+            f"re-run with --retry-failed to process them.")
+  else:
+    # After processing all files, flush the remaining buffered rows and close the Parquet files
+    for writer in writers.values():
+      try:
+        writer.close()
+        print(f"Wrote {writer.rows} rows to {writer.out_file}")
+      except Exception as e:
+        print(f"Error writing {writer.out_file}: {e}")
+
+  if key_index:
+    key_index.commit()
+    key_index.close()
+
+  # Sample account details for every account written, in one batch
+  if account_details_mode != "none":
+    enrich_accounts(os.path.join(output_folder, "Account.parquet"), account_details_mode)
 
   print("Parquet files have been generated in folder:", output_folder)
 
@@ -352,6 +1154,37 @@ if __name__ == "__main__":
   )
   parser.add_argument("json_file_or_folder", help="Path to the JSON file or folder containing JSON files.")
   parser.add_argument("output_folder", help="Folder to save the output Parquet files.")
+  parser.add_argument("--batch-rows", type=int, default=DEFAULT_BATCH_ROWS,
+                      help="Rows buffered per table before they are flushed to Parquet as a row group.")
+  parser.add_argument("--workers", type=int, default=1,
+                      help="Number of processes parsing JSON files in parallel.")
+  parser.add_argument("--since", type=datetime.date.fromisoformat, default=None,
+                      help="Only process logs delivered on or after this date (YYYY-MM-DD).")
+  parser.add_argument("--until", type=datetime.date.fromisoformat, default=None,
+                      help="Only process logs delivered on or before this date (YYYY-MM-DD).")
+  parser.add_argument("--checkpoint", action="store_true",
+                      help="Commit progress after every file so that an interrupted run can be resumed.")
+  parser.add_argument("--resume", action="store_true",
+                      help="Continue a checkpointed run from the last committed file.")
+  parser.add_argument("--retry-failed", action="store_true",
+                      help="Process only the files listed as failed by a previous checkpointed run.")
+  parser.add_argument("--stable-ids", action="store_true",
+                      help="Derive session and resource IDs from their natural keys instead of random UUIDs.")
+  parser.add_argument("--key-index", default=None,
+                      help="SQLite file of the keys already written, for dedup across incremental runs "
+                           "(implies --stable-ids).")
+  parser.add_argument("--raw-params", action="store_true",
+                      help="Copy request_params/response_params from the log text instead of re-encoding them.")
+  parser.add_argument("--promote-keys", nargs="*", default=None, metavar="KEY[:TYPE]",
+                      help="Add requestParameters keys to Event as typed columns (string, int64, float64 or bool; "
+                           f"default string). Without keys: {' '.join(DEFAULT_PROMOTED_KEYS)}.")
+  parser.add_argument("--account-details", choices=ACCOUNT_DETAILS_MODES, default="faker",
+                      help="Sample account alias/email/phone: Faker seeded per account (default), "
+                           "a Faker-free hash of the account ID, or none.")
+  parser.add_argument("--resource-rules", default=None,
+                      help="JSON file with extra resource type rules, checked before the built-in ones.")
+  parser.add_argument("--benchmark-rules", action="store_true",
+                      help="Benchmark resource type inference over the input files instead of converting them.")
   args = parser.parse_args()
 
   # Default input is a file or folder; output folder will be created if necessary.
@@ -360,9 +1193,20 @@ if __name__ == "__main__":
   if not os.path.exists(output_folder):
     os.makedirs(output_folder)
 
-  if os.path.isfile(input_path):
-    process_files(os.path.dirname(input_path), output_folder)
-  elif os.path.isdir(input_path):
-    process_files(input_path, output_folder)
+  promoted = None
+  try:
+    rules = ResourceTypeRules.from_file(args.resource_rules) if args.resource_rules else RESOURCE_RULES
+    if args.promote_keys is not None:
+      promoted = parse_promoted_keys(args.promote_keys or DEFAULT_PROMOTED_KEYS)
+  except ValueError as e:
+    parser.error(str(e))
+
+  if args.benchmark_rules:
+    benchmark_resource_rules(discover_files(input_path, args.since, args.until, exclude=output_folder), rules)
+  elif os.path.isfile(input_path) or os.path.isdir(input_path):
+    process_files(input_path, output_folder, batch_rows=args.batch_rows, workers=args.workers, since=args.since,
+                  until=args.until, rules=rules, checkpoint=args.checkpoint, resume=args.resume,
+                  retry_failed=args.retry_failed, stable_ids=args.stable_ids, key_index_file=args.key_index,
+                  raw_params=args.raw_params, promoted=promoted, account_details_mode=args.account_details)
   else:
     print(f"The path {input_path} is neither a file nor a directory.")
@@ -1,18 +1,43 @@
 #!/usr/bin/env python3
 import argparse
+import hashlib
 import json
 import os
+import pickle
+import queue
+import re
+import threading
+import time
 import uuid
+from datetime import datetime
 
 import ijson
 import pandas as pd
-from faker import Faker
-from pymongo import MongoClient
+from pymongo import MongoClient, UpdateOne, WriteConcern
+from pymongo.errors import BulkWriteError, PyMongoError
 
 CONNECTION_STRING = os.environ.get("MONGODB_CONNECTION_STRING")
 
-# Initialize Faker for generating sample account details
-fake = Faker()
+# Namespace of the stable, name-based (UUIDv5) resource and session IDs
+ID_NAMESPACE = uuid.uuid5(uuid.NAMESPACE_DNS, "cloudtrail.puppygraph.com")
+
+# Layout of CloudTrail eventTime and creationDate values
+TIME_FORMAT = "%Y-%m-%dT%H:%M:%SZ"
+# The same layout as a pattern, for the fast path of safe_time_strptime()
+TIME_PATTERN = re.compile(r"\d{4}-\d{2}-\d{2}T\d{2}:\d{2}:\d{2}Z", re.ASCII)
+# Parse timestamps per record, or per buffered batch just before it is inserted (see parse_times())
+TIME_PARSING_MODES = ("record", "batch")
+
+# How the sample account alias, email and phone are generated (see account_details())
+ACCOUNT_DETAILS_MODES = ("faker", "hash", "none")
+FIRST_NAMES = ["alex", "bailey", "casey", "dana", "eli", "finley", "gray", "harper", "indy", "jordan", "kai",
+               "logan", "morgan", "noel", "oakley", "parker", "quinn", "reese", "sage", "taylor", "uma", "val",
+               "wren", "xan", "yael", "zion", "ari", "blair", "cruz", "drew", "emery", "frankie"]
+LAST_NAMES = ["adams", "brooks", "chen", "diaz", "evans", "fischer", "garcia", "hughes", "ito", "jensen", "khan",
+              "lopez", "miller", "nguyen", "olsen", "patel", "quist", "rossi", "silva", "tanaka", "ueda", "vogel",
+              "walsh", "xu", "young", "zhang", "abe", "bauer", "costa", "dubois", "eriksen", "ferreira"]
+# Faker instance of each thread (see thread_faker())
+FAKERS = threading.local()
 
 COLLECTION_SCHEMA = {
   "Account": {
@@ -100,39 +125,296 @@ COLLECTION_SCHEMA = {
 }
 
 
-def batch_insert(collection, documents, batch_size=10000):
-    for i in range(0, len(documents), batch_size):
-        batch = documents[i:i + batch_size]
-        try:
-            collection.insert_many(batch)
-            print(f"Inserted batch {i//batch_size + 1}")
-        except Exception as e:
-            print(f"Error in batch {i//batch_size + 1}: {e}")
+# Documents buffered per collection before they are inserted
+DEFAULT_BATCH_SIZE = 10000
+# Natural key of each collection, used to replace the documents of an interrupted file
+COLLECTION_KEYS = {
+  "Account": "account_id",
+  "Identity": "identity_id",
+  "Session": "session_id",
+  "Event": "event_id",
+  "Resource": "resource_name",
+  "EventResource": "event_id"
+}
+# Unique key of each collection's documents for incremental upserts, and the generated fields an upsert
+# must not overwrite because documents loaded before refer to them
+UPSERT_KEYS = {
+  "Account": ("account_id",),
+  "Identity": ("identity_id",),
+  "Session": ("session_id",),
+  "Event": ("event_id",),
+  "Resource": ("resource_name",),
+  "EventResource": ("event_id", "resource_id")
+}
+INSERT_ONLY_FIELDS = {
+  "Resource": ("resource_id",)
+}
+# Fields PuppyGraph joins on (the vertex IDs and edge endpoints in schema.json), plus the natural keys above
+COLLECTION_INDEXES = {
+  "Account": ["account_id"],
+  "Identity": ["identity_id", "account_id"],
+  "Session": ["session_id", "identity_id"],
+  "Event": ["event_id", "session_id"],
+  "Resource": ["resource_id", "resource_name"],
+  "EventResource": ["event_id", "resource_id"]
+}
+# Insert errors kept per collection for the report
+MAX_REPORTED_ERRORS = 5
+# Writer threads and the batches each of them may have queued (see WriterPool)
+DEFAULT_WRITERS = 2
+DEFAULT_QUEUE_SIZE = 2
+# Write concerns for the bulk load: the server default, acknowledged without waiting for the journal,
+# or unacknowledged (insert errors are then not reported)
+WRITE_CONCERNS = {
+  "default": None,
+  "nojournal": WriteConcern(w=1, j=False),
+  "unacknowledged": WriteConcern(w=0)
+}
+
+
+class WriterPool:
+  """
+    Writer threads, each fed through its own bounded queue of batches, so that documents are
+    inserted while parsing goes on. A full queue blocks the parser until a batch is written,
+    which keeps at most workers * queue_size batches waiting in memory.
+    """
+
+  def __init__(self, workers=DEFAULT_WRITERS, queue_size=DEFAULT_QUEUE_SIZE):
+    self.queues = [queue.Queue(maxsize=queue_size) for _ in range(workers)]
+    self.next_queue = 0
+    self.error = None
+    self.threads = [threading.Thread(target=self.run, args=(q,), daemon=True) for q in self.queues]
+    for thread in self.threads:
+      thread.start()
+
+  def submit(self, task, pin=None):
+    """Queue task on the next writer, or always on the same one for a given pin to keep tasks in order."""
+    if pin is None:
+      pin = self.next_queue
+      self.next_queue += 1
+    self.queues[pin % len(self.queues)].put(task)
+
+  def run(self, tasks):
+    while True:
+      task = tasks.get()
+      try:
+        if task is None:
+          return
+        task()
+      except Exception as e:
+        if self.error is None:
+          self.error = e
+      finally:
+        tasks.task_done()
+
+  def wait(self, raise_error=True):
+    """Wait until every queued batch is written, then raise the first error of a writer thread."""
+    for tasks in self.queues:
+      tasks.join()
+    error, self.error = self.error, None
+    if error and raise_error:
+      raise error
+
+  def close(self):
+    for tasks in self.queues:
+      tasks.put(None)
+    for thread in self.threads:
+      thread.join()
+
+
+class CollectionWriter:
+  """
+    Bounded buffer of documents for one collection, inserted with insert_many(ordered=False)
+    whenever batch_size documents are buffered, so that a large file is never held in memory
+    at once. Documents rejected by a batch are counted without dropping the rest of the batch
+    or of the file. With replace, documents with the same natural key are deleted before each
+    batch is inserted, for files whose earlier import was interrupted. With a WriterPool, full
+    batches are handed to its threads instead of being written by the caller.
+
+    With upsert_keys, batches are written with bulk_write(UpdateOne(upsert=True)) keyed on those
+    fields instead, which makes replaying a file harmless; insert_only fields are only set when
+    a document is created.
+    """
+
+  def __init__(self, collection, key, batch_size=DEFAULT_BATCH_SIZE, prepare=None, pool=None, upsert_keys=None,
+               insert_only=()):
+    self.collection = collection
+    self.key = key
+    self.batch_size = batch_size
+    self.prepare = prepare
+    self.pool = pool
+    self.upsert_keys = upsert_keys
+    self.insert_only = insert_only
+    self.buffer = []
+    self.lock = threading.Lock()
+    self.start_file()
+
+  def start_file(self, replace=False):
+    """Reset the per-file counters; replace is set when the file was imported partly before."""
+    self.replace = replace
+    self.appended = 0
+    self.inserted = 0
+    self.failed = 0
+    self.errors = []
+
+  def __len__(self):
+    return self.appended
+
+  def append(self, document):
+    self.buffer.append(document)
+    self.appended += 1
+    if len(self.buffer) >= self.batch_size:
+      self.flush()
+
+  def flush(self):
+    if not self.buffer:
+      return
+    batch, self.buffer = self.buffer, []
+    if not self.pool:
+      self.write(batch, self.replace)
+    else:
+      # Replacing batches delete by key before inserting, so they stay in order on one writer
+      replace = self.replace
+      self.pool.submit(lambda: self.write(batch, replace), pin=hash(self.collection.name) if replace else None)
+
+  def write(self, batch, replace=False):
+    if self.prepare:
+      self.prepare(batch)
+    try:
+      if self.upsert_keys:
+        self.upsert(batch)
+        return
+      if replace:
+        self.collection.delete_many({self.key: {"$in": list({document[self.key] for document in batch})}})
+      self.count(len(self.collection.insert_many(batch, ordered=False).inserted_ids), 0)
+    except BulkWriteError as e:
+      # The other documents of an unordered batch are still written
+      written = e.details.get("nInserted", 0) + e.details.get("nUpserted", 0) + e.details.get("nMatched", 0)
+      self.count(written, len(batch) - written,
+                 [write_error.get("errmsg", "") for write_error in e.details.get("writeErrors", [])])
+    except PyMongoError as e:
+      self.count(0, len(batch), [f"{type(e).__name__}: {e}"])
+
+  def upsert(self, batch):
+    requests = []
+    for document in batch:
+      update = {"$set": {field: value for field, value in document.items() if field not in self.insert_only}}
+      if self.insert_only:
+        update["$setOnInsert"] = {field: document[field] for field in self.insert_only}
+      requests.append(UpdateOne({key: document[key] for key in self.upsert_keys}, update, upsert=True))
+    result = self.collection.bulk_write(requests, ordered=False)
+    # Unacknowledged writes report no counts
+    self.count(result.upserted_count + result.matched_count if result.acknowledged else len(batch), 0)
+
+  def count(self, inserted, failed, messages=()):
+    with self.lock:
+      self.inserted += inserted
+      self.failed += failed
+      for message in messages[:MAX_REPORTED_ERRORS - len(self.errors)]:
+        self.errors.append(' '.join(str(message).split()))
+
+  def discard(self):
+    self.buffer = []
+
+
+def thread_faker():
+  """
+    Return the Faker of the calling thread, created on its first call. Account batches are enriched
+    by the writer threads, and one instance cannot be reseeded from several threads at once.
+    """
+  fake = getattr(FAKERS, "fake", None)
+  if fake is None:
+    # Imported here so that runs without Faker details do not pay for (or need) it
+    from faker import Faker
+    fake = FAKERS.fake = Faker()
+  return fake
+
+
+def account_details(account_ids, mode="faker"):
+  """
+    Generate the sample alias, email and phone of every account in one batch, deterministic
+    per account_id. "faker" seeds Faker with each account_id, "hash" derives the details from
+    a hash of the account_id without importing Faker, and "none" leaves them empty.
+    Returns three lists in the order of account_ids.
+    """
+  if mode == "none":
+    return [""] * len(account_ids), [""] * len(account_ids), [""] * len(account_ids)
+  if mode == "faker":
+    fake = thread_faker()
+    aliases, emails, phones = [], [], []
+    for account_id in account_ids:
+      fake.seed_instance(account_id)
+      aliases.append(fake.user_name())
+      emails.append(fake.email())
+      phones.append(fake.phone_number())
+    return aliases, emails, phones
+  digests = [int.from_bytes(hashlib.blake2b(str(account_id).encode(), digest_size=8).digest(), "big")
+             for account_id in account_ids]
+  aliases = [f"{FIRST_NAMES[digest % 32]}.{LAST_NAMES[(digest >> 5) % 32]}{(digest >> 10) % 100}" for digest in digests]
+  emails = [f"{alias}@example.com" for alias in aliases]
+  phones = [f"555-{(digest >> 17) % 1000:03d}-{(digest >> 27) % 10000:04d}" for digest in digests]
+  return aliases, emails, phones
+
 
+def enrich_accounts(accounts_rows, mode="faker"):
+  """Fill in the sample details of a batch of Account rows in place (see account_details())."""
+  aliases, emails, phones = account_details([row["account_id"] for row in accounts_rows], mode)
+  for row, alias, email, phone in zip(accounts_rows, aliases, emails, phones):
+    row.update(account_alias=alias, email=email, phone=phone)
 
-def generate_session_id(identity_id, creation_date):
-  """Generate a simple session_id by concatenating identity_id and creation_date."""
+
+def generate_session_id(identity_id, creation_date, stable=False):
+  """
+    Generate a simple session_id by concatenating identity_id and creation_date,
+    or a UUID derived from them when stable is set.
+    """
+  if stable:
+    return str(uuid.uuid5(ID_NAMESPACE, f"session:{identity_id}_{creation_date}"))
   return f"{identity_id}_{creation_date}"
 
 
-def generate_resource_id():
-  """Generate a random UUID as resource_id."""
+def generate_resource_id(resource_name=None, stable=False):
+  """
+    Generate a random UUID as resource_id, or with stable a UUID derived from the resource name,
+    so that the same resource gets the same ID in every run and importer.
+    """
+  if stable:
+    return str(uuid.uuid5(ID_NAMESPACE, f"resource:{resource_name}"))
   return str(uuid.uuid4())
 
 
-def safe_time_strptime(date_str, date_format="%Y-%m-%dT%H:%M:%SZ"):
+def safe_time_strptime(date_str, date_format=TIME_FORMAT):
   """
     Safely parse a date string into a datetime object.
     Returns None if the string is empty or None.
+    CloudTrail timestamps (YYYY-MM-DDTHH:MM:SSZ) take a fixed-layout fast path.
     """
   if date_str:
     try:
-      return pd.to_datetime(date_str, format=date_format)
-    except ValueError:
+      if date_format == TIME_FORMAT and TIME_PATTERN.fullmatch(date_str):
+        return datetime.fromisoformat(date_str[:19])
+      return datetime.strptime(date_str, date_format)
+    except (TypeError, ValueError):
       print(f"Error parsing date: {date_str}")
   return None
 
 
+def parse_times(documents, field, date_format=TIME_FORMAT):
+  """
+    Convert the date strings of one field of a batch of documents in a single pandas call.
+    Empty values become None; malformed ones are logged and become None as well.
+    """
+  values = [document[field] or None for document in documents]
+  parsed = pd.to_datetime(pd.Series(values, dtype=object), format=date_format, errors="coerce")
+  for document, value, timestamp in zip(documents, values, parsed):
+    if pd.isna(timestamp):
+      if value:
+        print(f"Error parsing date: {value}")
+      document[field] = None
+    else:
+      document[field] = timestamp.to_pydatetime()
+
+
 def safe_json_dumps(data):
   """
     Convert data to JSON string.
@@ -152,156 +434,344 @@ def safe_get(data, key, default=''):
   return data.get(key) or default
 
 
-def infer_resource_type(request_params):
+# Built-in rules used by infer_resource_type(), in priority order: the first rule that matches wins.
+# A rule matches when every key of one of its "when" alternatives is present in requestParameters.
+# An alternative can also require a key's value to start with a string ("prefix") or to be a list ("list").
+DEFAULT_RESOURCE_RULES = [
+  {"type": "CloudTrailTrail", "when": [
+    {"keys": ["trailNameList"]},
+    {"keys": ["name", "s3BucketName"]},
+    {"keys": ["name", "enableLogFileValidation"]}]},
+  {"type": "S3Bucket", "when": [
+    {"keys": ["bucketName", "CreateBucketConfiguration"]},
+    {"keys": ["bucketName", "bucketPolicy"]},
+    {"keys": ["bucketName", "logging"]},
+    {"keys": ["bucketName", "replication"]},
+    {"keys": ["bucketName", "website"]},
+    {"keys": ["bucketName", "acl"]},
+    {"keys": ["bucketName", "tagging"]},
+    {"keys": ["bucketName", "versioning"]},
+    {"keys": ["bucketName", "policy"], "list": ["policy"]}]},
+  {"type": "EC2Instance", "when": [{"keys": ["instancesSet"]}]},
+  {"type": "AMI", "when": [{"keys": ["imagesSet"]}, {"keys": ["imageId"], "prefix": {"imageId": "ami-"}}]},
+  {"type": "Volume", "when": [{"keys": ["volumeSet"]}, {"keys": ["volumeId"]}]},
+  {"type": "Snapshot", "when": [{"keys": ["snapshotSet"]}, {"keys": ["snapshotId"]}]},
+  {"type": "AvailabilityZone", "when": [{"keys": ["availabilityZoneSet"]}]},
+  {"type": "SecurityGroup", "when": [
+    {"keys": ["securityGroupSet"]}, {"keys": ["securityGroupIdSet"]}, {"keys": ["ipPermissions"]}]},
+  {"type": "Subnet", "when": [{"keys": ["subnetSet"]}, {"keys": ["subnetId"]}]},
+  {"type": "VPC", "when": [{"keys": ["vpcSet"]}, {"keys": ["vpcId"]}]},
+  {"type": "IAMRole", "when": [
+    {"keys": ["roleName", "assumeRolePolicyDocument"]}, {"keys": ["roleName", "policyDocument"]}]},
+  {"type": "IAMPolicy", "when": [{"keys": ["policyName"]}, {"keys": ["policyArn"]}]},
+  {"type": "IAMInstanceProfile", "when": [{"keys": ["instanceProfileName"]}]},
+  {"type": "LambdaFunction", "when": [{"keys": ["functionName", "handler"]}]},
+  {"type": "APIGateway", "when": [{"keys": ["restApiId"]}]},
+  {"type": "CloudFormationStack", "when": [{"keys": ["stackStatusFilter"]}]},
+  {"type": "AWSConfig", "when": [{"keys": ["configurationRecorder"]}, {"keys": ["deliveryChannel"]}]},
+  {"type": "CustomerGateway", "when": [{"keys": ["customerGatewaySet"]}]},
+  {"type": "DHCPOptions", "when": [{"keys": ["dhcpOptionsSet"]}]},
+  {"type": "NetworkAcl", "when": [{"keys": ["networkAclIdSet"]}]},
+  {"type": "ReservedOrSpotInstances", "when": [
+    {"keys": ["reservedInstancesSet"]}, {"keys": ["spotInstanceRequestIdSet"]}]},
+  {"type": "CodeCommit", "when": [{"keys": ["repositoryNames"]}]},
+  {"type": "ACMCertificate", "when": [{"keys": ["certificateStatuses"]}]},
+  {"type": "MFADevice", "when": [{"keys": ["virtualMFADeviceName"]}, {"keys": ["serialNumber"]}]},
+  # Generic query: keys like maxResults, filterSet, nextToken, pageSize or limit exist
+  {"type": "GenericQuery", "when": [
+    {"keys": ["maxResults"]}, {"keys": ["nextToken"]}, {"keys": ["filterSet"]}, {"keys": ["pageSize"]},
+    {"keys": ["limit"]}]},
+]
+
+
+class ResourceTypeRules:
+  """
+    Resource type rules compiled into an index from trigger key to the rule alternatives that
+    key can satisfy, so a record only looks up its own requestParameters keys once instead of
+    walking every rule. Results are cached per key set, since the same API call always sends
+    the same requestParameters keys; records with keys whose values a rule inspects bypass the cache.
+    """
+
+  CACHE_SIZE = 65536
+
+  def __init__(self, rules):
+    self.index = {}
+    self.cache = {}
+    self.value_keys = set()
+    for priority, rule in enumerate(rules):
+      for condition in rule["when"]:
+        trigger, *other_keys = condition["keys"]
+        self.index.setdefault(trigger, []).append(
+          (priority, rule["type"], other_keys, condition.get("prefix", {}), condition.get("list", [])))
+        self.value_keys.update(condition.get("prefix", {}), condition.get("list", []))
+    for alternatives in self.index.values():
+      alternatives.sort(key=lambda alternative: alternative[0])
+
+  @classmethod
+  def from_file(cls, rules_file):
+    """
+      Load rules from a JSON file; they take precedence over the built-in rules. Raises ValueError
+      naming the first rule without a type or with a condition whose keys list is empty.
+      """
+    with open(rules_file) as f:
+      rules = json.load(f)
+    if not isinstance(rules, list):
+      raise ValueError(f"{rules_file} must hold a JSON list of resource type rules")
+    for number, rule in enumerate(rules, 1):
+      if not (isinstance(rule, dict) and rule.get("type") and isinstance(rule.get("when"), list) and rule["when"]
+              and all(isinstance(condition, dict) and condition.get("keys") for condition in rule["when"])):
+        raise ValueError(f"Resource type rule #{number} in {rules_file} needs a type and a non-empty "
+                         f"\"keys\" list in each \"when\" condition: {json.dumps(rule)}")
+    return cls(rules + DEFAULT_RESOURCE_RULES)
+
+  def infer(self, request_params):
+    if not self.value_keys.isdisjoint(request_params):
+      return self.match(request_params)
+    keys = tuple(request_params)
+    resource_type = self.cache.get(keys)
+    if resource_type is None:
+      if len(self.cache) >= self.CACHE_SIZE:
+        self.cache.clear()
+      resource_type = self.cache[keys] = self.match(request_params)
+    return resource_type
+
+  def match(self, request_params):
+    best_priority, best_type = None, ''
+    for key in request_params:
+      for priority, resource_type, other_keys, prefixes, list_keys in self.index.get(key, ()):
+        if best_priority is not None and priority >= best_priority:
+          break
+        if (all(other in request_params for other in other_keys)
+                and all(isinstance(request_params.get(k), str) and request_params[k].startswith(prefix)
+                        for k, prefix in prefixes.items())
+                and all(isinstance(request_params.get(k), list) for k in list_keys)):
+          best_priority, best_type = priority, resource_type
+          break
+    return best_type
+
+
+RESOURCE_RULES = ResourceTypeRules(DEFAULT_RESOURCE_RULES)
+
+
+def infer_resource_type(request_params, rules=None):
   """
-    Infer a resource type string based on keys in requestParameters.
+    Infer a resource type string based on keys in requestParameters, using the built-in
+    rules unless rules (a ResourceTypeRules) is given.
     Returns a tuple: (resource_type, extra_metadata).
     """
   if not request_params:
     return '', {}
+  return (rules or RESOURCE_RULES).infer(request_params), {}
 
-  # CloudTrail Trail
-  if 'trailNameList' in request_params or ('name' in request_params and (
-          's3BucketName' in request_params or 'enableLogFileValidation' in request_params)):
-    return 'CloudTrailTrail', {}
-
-  # S3 Bucket related requests
-  if 'bucketName' in request_params and (
-          'CreateBucketConfiguration' in request_params or
-          'bucketPolicy' in request_params or
-          'logging' in request_params or
-          'replication' in request_params or
-          'website' in request_params or
-          'acl' in request_params or
-          'tagging' in request_params or
-          'versioning' in request_params or
-          ('policy' in request_params and isinstance(request_params.get('policy'), list))):
-    return 'S3Bucket', {}
-
-  # EC2 Instance related
-  if 'instancesSet' in request_params:
-    return 'EC2Instance', {}
-
-  # AMI / Images
-  if 'imagesSet' in request_params or (
-          'imageId' in request_params and request_params.get('imageId', '').startswith('ami-')):
-    return 'AMI', {}
-
-  # Volume related
-  if 'volumeSet' in request_params or 'volumeId' in request_params:
-    return 'Volume', {}
-
-  # Snapshot related
-  if 'snapshotSet' in request_params or 'snapshotId' in request_params:
-    return 'Snapshot', {}
-
-  # Availability Zone
-  if 'availabilityZoneSet' in request_params:
-    return 'AvailabilityZone', {}
-
-  # Security Group
-  if 'securityGroupSet' in request_params or 'securityGroupIdSet' in request_params or 'ipPermissions' in request_params:
-    return 'SecurityGroup', {}
-
-  # Subnet
-  if 'subnetSet' in request_params or 'subnetId' in request_params:
-    return 'Subnet', {}
-
-  # VPC
-  if 'vpcSet' in request_params or 'vpcId' in request_params:
-    return 'VPC', {}
-
-  # IAM Role related
-  if 'roleName' in request_params and (
-          'assumeRolePolicyDocument' in request_params or 'policyDocument' in request_params):
-    return 'IAMRole', {}
-
-  # IAM Policy related
-  if 'policyName' in request_params or 'policyArn' in request_params:
-    return 'IAMPolicy', {}
-
-  # Instance Profile
-  if 'instanceProfileName' in request_params:
-    return 'IAMInstanceProfile', {}
-
-  # Lambda Function
-  if 'functionName' in request_params and 'handler' in request_params:
-    return 'LambdaFunction', {}
-
-  # API Gateway related (could be refined further)
-  if 'restApiId' in request_params:
-    return 'APIGateway', {}
-
-  # CloudFormation Stack
-  if 'stackStatusFilter' in request_params:
-    return 'CloudFormationStack', {}
-
-  # AWS Config / configuration recorder
-  if 'configurationRecorder' in request_params or 'deliveryChannel' in request_params:
-    return 'AWSConfig', {}
-
-  # Network related resources
-  if 'customerGatewaySet' in request_params:
-    return 'CustomerGateway', {}
-  if 'dhcpOptionsSet' in request_params:
-    return 'DHCPOptions', {}
-  if 'networkAclIdSet' in request_params:
-    return 'NetworkAcl', {}
-
-  # Reserved Instances or Spot Instance Requests
-  if 'reservedInstancesSet' in request_params or 'spotInstanceRequestIdSet' in request_params:
-    return 'ReservedOrSpotInstances', {}
-
-  # CodeCommit repository
-  if 'repositoryNames' in request_params:
-    return 'CodeCommit', {}
-
-  # ACM Certificate
-  if 'certificateStatuses' in request_params:
-    return 'ACMCertificate', {}
-
-  # MFA Device
-  if 'virtualMFADeviceName' in request_params or 'serialNumber' in request_params:
-    return 'MFADevice', {}
 
-  # Generic query: keys like maxResults, filterSet, nextToken, pageSize or limit exist
-  if any(k in request_params for k in ['maxResults', 'nextToken', 'filterSet', 'pageSize', 'limit']):
-    return 'GenericQuery', {}
+class TrackedSet(set):
+  """Dedup set that also lists the keys added since the last ledger commit."""
+
+  def __init__(self, keys=()):
+    super().__init__(keys)
+    self.added = []
 
-  # Default: return an empty type
-  return '', {}
+  def add(self, key):
+    super().add(key)
+    self.added.append(key)
 
 
-def process_files(input_path, dbname):
+class IngestLedger:
+  """
+    Ledger of the input files already imported into a database, kept as <checkpoint_dir>/<dbname>.json
+    together with the dedup keys added by each committed file (one delta file per commit, merged
+    on resume), so that an interrupted import can resume after the last committed file. Files whose
+    documents were inserted only in part are recorded as partial, and their documents are replaced
+    when they are imported again.
+    """
+
+  def __init__(self, checkpoint_dir, dbname, resume=False):
+    os.makedirs(checkpoint_dir, exist_ok=True)
+    self.ledger_file = os.path.join(checkpoint_dir, f"{dbname}.json")
+    self.delta_prefix = os.path.join(checkpoint_dir, f"{dbname}-dedup-")
+    if resume and os.path.exists(self.ledger_file):
+      with open(self.ledger_file) as f:
+        self.ledger = json.load(f)
+    else:
+      self.ledger = {"processed": {}, "failed": {}, "partial": [], "deltas": 0}
+      for file_name in os.listdir(checkpoint_dir):
+        if file_name.startswith(os.path.basename(self.delta_prefix)) and file_name.endswith(".pickle"):
+          os.remove(os.path.join(checkpoint_dir, file_name))
+
+  def pending(self, file_paths, retry_failed=False):
+    """Return the files still to import: the failed ones only with retry_failed."""
+    if retry_failed:
+      return [file_path for file_path in file_paths if os.path.abspath(file_path) in self.ledger["failed"]]
+    return [file_path for file_path in file_paths if os.path.abspath(file_path) not in self.ledger["processed"]]
+
+  def delta_file(self, index):
+    return f"{self.delta_prefix}{index:05d}.pickle"
+
+  def load_seen(self):
+    """Return the account, identity, session and resource dedup sets as of the last commit."""
+    seen = TrackedSet(), TrackedSet(), TrackedSet(), TrackedSet()
+    for index in range(self.ledger["deltas"]):
+      with open(self.delta_file(index), "rb") as f:
+        for keys, added in zip(seen, pickle.load(f)):
+          keys.update(added)
+    return seen
+
+  def interrupted(self, file_path):
+    return os.path.abspath(file_path) in self.ledger["partial"]
+
+  def start(self, file_path):
+    """Record that the documents of file_path are being inserted, until it is committed."""
+    if not self.interrupted(file_path):
+      self.ledger["partial"].append(os.path.abspath(file_path))
+    self.save()
+
+  def commit(self, file_path, seen, records):
+    # Only the keys added since the last commit; the ledger write below is the commit point
+    index = self.ledger["deltas"]
+    with open(self.delta_file(index), "wb") as f:
+      pickle.dump([keys.added for keys in seen], f, protocol=pickle.HIGHEST_PROTOCOL)
+    for keys in seen:
+      keys.added = []
+    self.ledger["deltas"] = index + 1
+    file_path = os.path.abspath(file_path)
+    self.ledger["processed"][file_path] = {"bytes": os.path.getsize(file_path), "records": records}
+    self.ledger["failed"].pop(file_path, None)
+    self.ledger["partial"].remove(file_path)
+    self.save()
+
+  def fail(self, file_path, error):
+    # Keep the message on one line
+    self.ledger["failed"][os.path.abspath(file_path)] = f"{type(error).__name__}: {' '.join(str(error).split())}"
+    self.save()
+
+  def save(self):
+    with open(self.ledger_file + ".tmp", "w") as f:
+      json.dump(self.ledger, f, indent=2)
+    os.replace(self.ledger_file + ".tmp", self.ledger_file)
+
+
+def attach_validators(db):
+  """Attach the $jsonSchema validator of each collection after a bulk load, with collMod."""
+  for collection_name, schema in COLLECTION_SCHEMA.items():
+    db.command("collMod", collection_name, validator=schema)
+
+
+def create_indexes(db):
+  """Create the indexes in COLLECTION_INDEXES; indexes that already exist are left as they are."""
+  for collection_name, fields in COLLECTION_INDEXES.items():
+    for field in fields:
+      db[collection_name].create_index(field)
+
+
+def load_existing_keys(db):
+  """
+    Return the account, identity, session and resource dedup sets of the documents already in db.
+    Each set is read from the index on its key by a covered projection query, without fetching
+    the documents.
+    """
+  seen = []
+  for collection_name, key in (("Account", "account_id"), ("Identity", "identity_id"), ("Session", "session_id"),
+                               ("Resource", "resource_name")):
+    cursor = db[collection_name].find({}, {key: 1, "_id": 0}).hint([(key, 1)])
+    seen.append(TrackedSet(document[key] for document in cursor if document.get(key)))
+  return tuple(seen)
+
+
+def process_files(input_path, dbname, *, rules=None, checkpoint_dir=None, resume=False, retry_failed=False,
+                  stable_ids=False, account_details_mode="faker", batch_size=DEFAULT_BATCH_SIZE,
+                  time_parsing="record", workers=DEFAULT_WRITERS, queue_size=DEFAULT_QUEUE_SIZE,
+                  max_pool_size=None, write_concern="default", bulk_load=False, incremental=False):
   """
     Process all JSON files in the input folder (each should have a top-level "Records" array),
     extract data for Account, Identity, Session, Event, Resource, and EventResource tables,
-    and then write each table to a database in MongoDB Atlas.
+    and then write each table to a database in MongoDB Atlas. Documents are inserted in batches
+    of batch_size per collection while the file is parsed.
+
+    With checkpoint_dir, each imported file is committed to an IngestLedger; resume keeps the
+    existing collections and skips the committed files, and retry_failed imports only the
+    files that failed before.
+
+    With stable_ids, session and resource IDs are derived from their natural keys instead of
+    being random, so re-imports and imports into other sinks agree on them.
+    The sample account details of new accounts are generated one batch at a time before they
+    are inserted, as set by account_details_mode. With time_parsing "batch", event times and
+    session creation dates are kept as strings until their batch is converted by parse_times().
+    Batches are written by a WriterPool of workers threads sharing one client, whose connection
+    pool holds max_pool_size connections (one per writer and one for the main thread by default);
+    write_concern names one of WRITE_CONCERNS.
+
+    The collections are created with their validators and indexes before the import. With
+    bulk_load, they are created bare instead and the validators and indexes are added in one
+    phase after the last file, so that inserts skip validation and index maintenance. That phase
+    also runs when the import stops on a failed file.
+
+    With incremental, the existing collections are kept and added to: the dedup sets are seeded
+    with the keys already stored (see load_existing_keys()) and documents are upserted by their
+    UPSERT_KEYS, so loading new logs does not mean reloading the old ones.
+    The time of each phase is printed at the end.
     """
+  resume = resume or retry_failed
+  ledger = IngestLedger(checkpoint_dir, dbname, resume) if checkpoint_dir else None
+  phase_times = {}
+  phase_start = time.perf_counter()
   try:
-    client = MongoClient(CONNECTION_STRING)
+    client = MongoClient(CONNECTION_STRING, maxPoolSize=max_pool_size or workers + 1)
     db = client[dbname]
     for collection_name, schema in COLLECTION_SCHEMA.items():
       if collection_name in db.list_collection_names():
+        if resume or incremental:
+          continue
         db.drop_collection(collection_name)
-      db.create_collection(collection_name, validator=schema)
+      if bulk_load:
+        db.create_collection(collection_name)
+      else:
+        db.create_collection(collection_name, validator=schema)
+    # Incremental loads look up and upsert by key, so they need the indexes from the start
+    if not bulk_load or incremental:
+      create_indexes(db)
   except Exception as e:
     print(f"Error connecting to MongoDB and creating collections: {e}")
     return
+  phase_times["setup"] = time.perf_counter() - phase_start
+  phase_start = time.perf_counter()
 
-  # Lists to accumulate rows for each table
-  accounts_rows = []
-  identity_rows = []
-  session_rows = []
-  event_rows = []
-  resource_rows = []
-  event_resource_rows = []
+  # Bounded buffers of documents for each collection, flushed as they fill
+  pool = WriterPool(workers, queue_size)
+  writers = {collection_name: CollectionWriter(db.get_collection(collection_name,
+                                                                 write_concern=WRITE_CONCERNS[write_concern]),
+                                               key, batch_size, pool=pool)
+             for collection_name, key in COLLECTION_KEYS.items()}
+  writers["Account"].prepare = lambda batch: enrich_accounts(batch, account_details_mode)
+  if incremental:
+    for collection_name, writer in writers.items():
+      writer.upsert_keys = UPSERT_KEYS[collection_name]
+      writer.insert_only = INSERT_ONLY_FIELDS.get(collection_name, ())
+  if time_parsing == "batch":
+    parse_time = str
+    writers["Session"].prepare = lambda batch: parse_times(batch, "creation_date")
+    writers["Event"].prepare = lambda batch: parse_times(batch, "event_time")
+  else:
+    parse_time = safe_time_strptime
+  accounts_rows = writers["Account"]
+  identity_rows = writers["Identity"]
+  session_rows = writers["Session"]
+  event_rows = writers["Event"]
+  resource_rows = writers["Resource"]
+  event_resource_rows = writers["EventResource"]
 
-  # Deduplication sets based on natural keys
-  accounts_set = set()
-  identities_set = set()
-  sessions_set = set()
-  resources_set = set()  # use natural resource name as key
+  # Deduplication sets based on natural keys (restored from the last commit when resuming,
+  # or from the database for incremental loads)
+  if incremental:
+    accounts_set, identities_set, sessions_set, resources_set = load_existing_keys(db)
+    print(f"Found {len(accounts_set)} accounts, {len(identities_set)} identities, {len(sessions_set)} sessions "
+          f"and {len(resources_set)} resources already in {dbname}.")
+  elif ledger:
+    accounts_set, identities_set, sessions_set, resources_set = ledger.load_seen()
+  else:
+    accounts_set = set()
+    identities_set = set()
+    sessions_set = set()
+    resources_set = set()  # use natural resource name as key
 
   if os.path.isfile(input_path):
     input_folder = os.path.dirname(input_path)
@@ -313,10 +783,22 @@ def process_files(input_path, dbname):
   
   total_files = len(json_files)
   print(f"Found {total_files} JSON file(s) in {input_folder}.")
+  if ledger:
+    json_files = [os.path.relpath(file_path, input_folder) for file_path in
+                  ledger.pending([os.path.join(input_folder, f) for f in json_files], retry_failed)]
+    print(f"{total_files - len(json_files)} file(s) already imported or skipped, {len(json_files)} to import.")
 
+  stopped = False
   for json_file in json_files:
     file_path = os.path.join(input_folder, json_file)
     print(f"Processing file: {file_path}")
+    replace = bool(ledger) and ledger.interrupted(file_path)
+    if replace:
+      print(f"Replacing documents left by the interrupted import of {file_path}")
+    for writer in writers.values():
+      writer.start_file(replace)
+    if ledger:
+      ledger.start(file_path)
     try:
       with open(file_path, 'r', encoding='utf-8') as f:
         for record in ijson.items(f, "Records.item"):
@@ -327,9 +809,9 @@ def process_files(input_path, dbname):
             accounts_set.add(account_id)
             accounts_rows.append({
               "account_id": str(account_id),  # Ensure account_id is stored as string
-              "account_alias": fake.user_name(),
-              "email": fake.email(),
-              "phone": fake.phone_number()
+              "account_alias": "",
+              "email": "",
+              "phone": ""
             })
 
           # Process Identity table
@@ -350,7 +832,7 @@ def process_files(input_path, dbname):
           attributes = session_context.get("attributes", {}) or {}
           creation_date = safe_get(attributes, "creationDate")
           if creation_date:
-            session_id = generate_session_id(identity_id, creation_date)
+            session_id = generate_session_id(identity_id, creation_date, stable_ids)
             if session_id not in sessions_set:
               sessions_set.add(session_id)
               additional_info = {
@@ -359,7 +841,7 @@ def process_files(input_path, dbname):
               }
               session_rows.append({
                 "session_id": session_id,
-                "creation_date": safe_time_strptime(creation_date),
+                "creation_date": parse_time(creation_date),
                 "mfa_authenticated": str(safe_get(attributes, "mfaAuthenticated", "false")).lower() == "true",
                 "additional_info": safe_json_dumps(additional_info),
                 "identity_id": identity_id
@@ -378,7 +860,7 @@ def process_files(input_path, dbname):
           response_params_raw = record.get("responseElements") or {}
           event_rows.append({
             "event_id": event_id,
-            "event_time": safe_time_strptime(event_time),
+            "event_time": parse_time(event_time),
             "event_source": event_source,
             "event_name": event_name,
             "source_ip": source_ip,
@@ -399,7 +881,7 @@ def process_files(input_path, dbname):
             natural_name = safe_get(item, "instanceId")
             if natural_name and natural_name not in resources_set:
               resources_set.add(natural_name)
-              generated_resource_id = generate_resource_id()
+              generated_resource_id = generate_resource_id(natural_name, stable_ids)
               resource_rows.append({
                 "resource_id": generated_resource_id,
                 "resource_name": natural_name,
@@ -414,7 +896,7 @@ def process_files(input_path, dbname):
               })
 
           # Process Resource inferred from requestParameters as fallback
-          resource_type, extra_metadata = infer_resource_type(request_params_raw)
+          resource_type, extra_metadata = infer_resource_type(request_params_raw, rules)
           if resource_type:
             # Determine natural name using common keys ("name", "bucketName", "instanceId")
             natural_name = safe_get(request_params_raw, "name")
@@ -424,7 +906,7 @@ def process_files(input_path, dbname):
               natural_name = safe_get(request_params_raw, "instanceId")
             if natural_name and natural_name not in resources_set:
               resources_set.add(natural_name)
-              generated_resource_id = generate_resource_id()
+              generated_resource_id = generate_resource_id(natural_name, stable_ids)
               resource_rows.append({
                 "resource_id": generated_resource_id,
                 "resource_name": natural_name,
@@ -437,41 +919,70 @@ def process_files(input_path, dbname):
                 "pre_state": "",
                 "post_state": ""
               })
+        # Insert what is left in the buffers
+        for writer in writers.values():
+          writer.flush()
+        pool.wait()
       print(f"Processed {len(accounts_rows)} Account rows, {len(identity_rows)} Identity rows, {len(session_rows)} Session rows, {len(event_rows)} Event rows, {len(resource_rows)} Resource rows, and {len(event_resource_rows)} EventResource rows from file: {file_path}")
     except Exception as e:
       print(f"Error processing file {file_path}: {e}")
-      return
-    
+      for writer in writers.values():
+        writer.discard()
+      pool.wait(raise_error=False)
+      if not ledger:
+        stopped = True
+        break
+      ledger.fail(file_path, e)
+      if any(writer.inserted for writer in writers.values()):
+        # Part of the file is already in the database: stop, it is replaced when the import is resumed
+        stopped = True
+        break
+      # Skip the file: restore the dedup sets, then go on with the next one
+      accounts_set, identities_set, sessions_set, resources_set = load_existing_keys(db) if incremental \
+        else ledger.load_seen()
+      continue
+
+    print(f"Wrote {', '.join(f'{writer.inserted} {name}' for name, writer in writers.items())} documents.")
+    failed = {name: writer for name, writer in writers.items() if writer.failed}
+    if failed:
+      for name, writer in failed.items():
+        print(f"{writer.failed} {name} document(s) failed to insert: {'; '.join(writer.errors)}")
+      if ledger:
+        ledger.fail(file_path, PyMongoError(
+          ", ".join(f"{writer.failed} {name} document(s) failed to insert" for name, writer in failed.items())))
+      stopped = True
+      break
+
+    if ledger:
+      ledger.commit(file_path, (accounts_set, identities_set, sessions_set, resources_set), len(event_rows))
+  pool.close()
+  phase_times["load"] = time.perf_counter() - phase_start
+  if stopped:
+    if ledger:
+      print("The import stopped on a failed file; fix it and re-run with --resume to import the rest.")
+    else:
+      print("The import stopped on a failed file; fix it and re-run the import.")
+
+  # Even when the import stopped, so that the collections are not left without validators and indexes
+  if bulk_load:
     try:
-      # Insert data into MongoDB collections
-      print(f"Inserting data into MongoDB collections...")
-      if accounts_rows:
-        batch_insert(db.Account, accounts_rows)
-        print(f"Inserted {len(accounts_rows)} Account rows.")
-        accounts_rows = []
-      if identity_rows:
-        batch_insert(db.Identity, identity_rows)
-        print(f"Inserted {len(identity_rows)} Identity rows.")
-        identity_rows = []     
-      if session_rows:
-        batch_insert(db.Session, session_rows)
-        print(f"Inserted {len(session_rows)} Session rows.")
-        session_rows = []     
-      if event_rows:
-        batch_insert(db.Event, event_rows)
-        print(f"Inserted {len(event_rows)} Event rows.")
-        event_rows = []    
-      if resource_rows:
-        db.Resource.insert_many(resource_rows)
-        print(f"Inserted {len(resource_rows)} Resource rows.")
-        resource_rows = []   
-      if event_resource_rows:
-        batch_insert(db.EventResource, event_resource_rows)
-        print(f"Inserted {len(event_resource_rows)} EventResource rows.")
-        event_resource_rows = []    
-    except Exception as e:
-      print(f"Error inserting data into MongoDB: {e}")
-      return
+      phase_start = time.perf_counter()
+      attach_validators(db)
+      phase_times["validators"] = time.perf_counter() - phase_start
+      phase_start = time.perf_counter()
+      create_indexes(db)
+      phase_times["indexes"] = time.perf_counter() - phase_start
+    except PyMongoError as e:
+      print(f"Error adding the validators and indexes after the bulk load: {e}")
+  print(f"Phase times: {', '.join(f'{phase} {seconds:.1f}s' for phase, seconds in phase_times.items())}")
+
+
+def positive_int(value):
+  """argparse type for counts that must be at least 1."""
+  number = int(value)
+  if number < 1:
+    raise argparse.ArgumentTypeError(f"must be at least 1, got {value}")
+  return number
 
 
 if __name__ == "__main__":
@@ -480,12 +991,53 @@ if __name__ == "__main__":
   )
   parser.add_argument("json_file_or_folder", help="Path to the JSON file or folder containing JSON files.")
   parser.add_argument("--database", default="cloudtrail", help="Target database. Use lowercase.")
+  parser.add_argument("--checkpoint", action="store_true",
+                      help="Record each imported file in a ledger so that an interrupted import can be resumed.")
+  parser.add_argument("--checkpoint-dir", default=".checkpoint",
+                      help="Folder for the ledger and dedup snapshot (default: .checkpoint).")
+  parser.add_argument("--resume", action="store_true",
+                      help="Keep the existing collections and skip the files already imported.")
+  parser.add_argument("--retry-failed", action="store_true",
+                      help="Keep the existing collections and import only the files that failed before.")
+  parser.add_argument("--stable-ids", action="store_true",
+                      help="Derive session and resource IDs from their natural keys instead of random UUIDs.")
+  parser.add_argument("--account-details", choices=ACCOUNT_DETAILS_MODES, default="faker",
+                      help="Sample account alias/email/phone: Faker seeded per account (default), "
+                           "a Faker-free hash of the account ID, or none.")
+  parser.add_argument("--batch-size", type=positive_int, default=DEFAULT_BATCH_SIZE,
+                      help=f"Documents buffered per collection before they are inserted (default: {DEFAULT_BATCH_SIZE}).")
+  parser.add_argument("--time-parsing", choices=TIME_PARSING_MODES, default="record",
+                      help="Parse timestamps per record (default) or per batch of documents before insert.")
+  parser.add_argument("--writers", type=positive_int, default=DEFAULT_WRITERS,
+                      help=f"Threads inserting batches while files are parsed (default: {DEFAULT_WRITERS}).")
+  parser.add_argument("--queue-size", type=positive_int, default=DEFAULT_QUEUE_SIZE,
+                      help=f"Batches each writer may have queued before parsing waits (default: {DEFAULT_QUEUE_SIZE}).")
+  parser.add_argument("--max-pool-size", type=positive_int, default=None,
+                      help="Connections in the MongoDB client pool (default: one per writer plus one).")
+  parser.add_argument("--write-concern", choices=list(WRITE_CONCERNS), default="default",
+                      help="Write concern for the bulk load: the server default, w=1 without journaling, "
+                           "or unacknowledged writes (insert errors are not reported).")
+  parser.add_argument("--incremental", action="store_true",
+                      help="Keep the existing collections and upsert the new documents by natural key.")
+  parser.add_argument("--bulk-load", action="store_true",
+                      help="Create the collections without validators and indexes, and add them after the import.")
+  parser.add_argument("--resource-rules", default=None,
+                      help="JSON file with extra resource type rules, checked before the built-in ones.")
   args = parser.parse_args()
 
   # Default input is a file or folder; output folder will be created if necessary.
   input_path = args.json_file_or_folder
 
   if os.path.isfile(input_path) or os.path.isdir(input_path):
-    process_files(input_path, args.database)
+    try:
+      rules = ResourceTypeRules.from_file(args.resource_rules) if args.resource_rules else RESOURCE_RULES
+    except ValueError as e:
+      parser.error(str(e))
+    checkpoint_dir = args.checkpoint_dir if args.checkpoint or args.resume or args.retry_failed else None
+    process_files(input_path, args.database, rules=rules, checkpoint_dir=checkpoint_dir, resume=args.resume,
+                  retry_failed=args.retry_failed, stable_ids=args.stable_ids, account_details_mode=args.account_details,
+                  batch_size=args.batch_size, time_parsing=args.time_parsing, workers=args.writers,
+                  queue_size=args.queue_size, max_pool_size=args.max_pool_size, write_concern=args.write_concern,
+                  bulk_load=args.bulk_load, incremental=args.incremental)
   else:
     print(f"The path {input_path} is neither a file nor a directory.")
@@ -1,24 +1,117 @@
 #!/usr/bin/env python3
 import argparse
+import contextlib
+import datetime
+import functools
+import hashlib
 import json
 import os
+import re
+import shutil
+import tempfile
+import time
 import uuid
+from concurrent.futures import ThreadPoolExecutor, as_completed
 
 import ijson
-from faker import Faker
 from pyspark.sql import SparkSession
-
-# Initialize Faker for generating sample account details
-fake = Faker()
-
-
-def generate_session_id(identity_id, creation_date):
-  # Generate a simple session_id by concatenating identity_id and creation_date
+from pyspark.sql.types import BooleanType, StringType, StructField, StructType, TimestampType
+
+# Columns and Spark SQL types of each table, in table order. This is the single source of the table
+# definitions: create_tables() builds the DDL from it, and the Spark and Arrow load schemas are derived from it.
+TABLE_COLUMNS = {
+  "account": [("account_id", "STRING"), ("account_alias", "STRING"), ("email", "STRING"), ("phone", "STRING")],
+  "identity": [("identity_id", "STRING"), ("type", "STRING"), ("principal_id", "STRING"), ("arn", "STRING"),
+               ("user_name", "STRING"), ("account_id", "STRING")],
+  "session": [("session_id", "STRING"), ("creation_date", "TIMESTAMP"), ("mfa_authenticated", "BOOLEAN"),
+              ("additional_info", "STRING"), ("identity_id", "STRING")],
+  "event": [("event_id", "STRING"), ("event_time", "TIMESTAMP"), ("event_source", "STRING"), ("event_name", "STRING"),
+            ("source_ip", "STRING"), ("user_agent", "STRING"), ("request_params", "STRING"),
+            ("response_params", "STRING"), ("identity_id", "STRING"), ("session_id", "STRING"),
+            ("account_id", "STRING")],
+  "resource": [("resource_id", "STRING"), ("resource_name", "STRING"), ("resource_type", "STRING"),
+               ("additional_metadata", "STRING")],
+  "eventresource": [("event_id", "STRING"), ("resource_id", "STRING"), ("pre_state", "STRING"),
+                    ("post_state", "STRING")],
+}
+
+# Format of the CloudTrail timestamps (eventTime, creationDate)
+TIMESTAMP_FORMAT = "%Y-%m-%dT%H:%M:%SZ"
+
+# Retries of a table commit that lost an optimistic-concurrency race in the catalog, with exponential backoff
+COMMIT_RETRIES = 5
+COMMIT_RETRY_DELAY = 1.0
+
+# Natural key of each table, used by the merge write mode
+MERGE_KEYS = {
+  "account": ["account_id"],
+  "identity": ["identity_id"],
+  "session": ["session_id"],
+  "event": ["event_id"],
+  "resource": ["resource_name"],
+  "eventresource": ["event_id", "resource_id"],
+}
+
+SPARK_TYPES = {"STRING": StringType(), "BOOLEAN": BooleanType(), "TIMESTAMP": TimestampType()}
+
+# How the sample account alias, email and phone are generated (see account_details())
+ACCOUNT_DETAILS_MODES = ("faker", "hash", "none")
+FIRST_NAMES = ["alex", "bailey", "casey", "dana", "eli", "finley", "gray", "harper", "indy", "jordan", "kai",
+               "logan", "morgan", "noel", "oakley", "parker", "quinn", "reese", "sage", "taylor", "uma", "val",
+               "wren", "xan", "yael", "zion", "ari", "blair", "cruz", "drew", "emery", "frankie"]
+LAST_NAMES = ["adams", "brooks", "chen", "diaz", "evans", "fischer", "garcia", "hughes", "ito", "jensen", "khan",
+              "lopez", "miller", "nguyen", "olsen", "patel", "quist", "rossi", "silva", "tanaka", "ueda", "vogel",
+              "walsh", "xu", "young", "zhang", "abe", "bauer", "costa", "dubois", "eriksen", "ferreira"]
+
+# Namespace of the stable, name-based (UUIDv5) resource and session IDs
+ID_NAMESPACE = uuid.uuid5(uuid.NAMESPACE_DNS, "cloudtrail.puppygraph.com")
+
+
+def account_details(account_ids, mode="faker"):
+  # Generate the sample alias, email and phone of every account in one batch, deterministic per account_id:
+  # "faker" seeds Faker with each account_id, "hash" derives the details from a hash of the account_id
+  # without importing Faker, and "none" leaves them empty. Returns three lists in the order of account_ids.
+  if mode == "none":
+    return [""] * len(account_ids), [""] * len(account_ids), [""] * len(account_ids)
+  if mode == "faker":
+    # Imported here so that runs without Faker details do not pay for (or need) it
+    from faker import Faker
+    fake = Faker()
+    aliases, emails, phones = [], [], []
+    for account_id in account_ids:
+      fake.seed_instance(account_id)
+      aliases.append(fake.user_name())
+      emails.append(fake.email())
+      phones.append(fake.phone_number())
+    return aliases, emails, phones
+  digests = [int.from_bytes(hashlib.blake2b(str(account_id).encode(), digest_size=8).digest(), "big")
+             for account_id in account_ids]
+  aliases = [f"{FIRST_NAMES[digest % 32]}.{LAST_NAMES[(digest >> 5) % 32]}{(digest >> 10) % 100}" for digest in digests]
+  emails = [f"{alias}@example.com" for alias in aliases]
+  phones = [f"555-{(digest >> 17) % 1000:03d}-{(digest >> 27) % 10000:04d}" for digest in digests]
+  return aliases, emails, phones
+
+
+def enrich_accounts(accounts_rows, mode="faker"):
+  # Fill in the sample details of a batch of account rows in place
+  aliases, emails, phones = account_details([row["account_id"] for row in accounts_rows], mode)
+  for row, alias, email, phone in zip(accounts_rows, aliases, emails, phones):
+    row.update(account_alias=alias, email=email, phone=phone)
+
+
+def generate_session_id(identity_id, creation_date, stable=False):
+  # Generate a simple session_id by concatenating identity_id and creation_date,
+  # or a UUID derived from them when stable is set
+  if stable:
+    return str(uuid.uuid5(ID_NAMESPACE, f"session:{identity_id}_{creation_date}"))
   return f"{identity_id}_{creation_date}"
 
 
-def generate_resource_id():
-  # Generate a random UUID as resource_id
+def generate_resource_id(resource_name=None, stable=False):
+  # Generate a random UUID as resource_id, or with stable a UUID derived from the resource name
+  # so that the same resource gets the same ID in every run and importer
+  if stable:
+    return str(uuid.uuid5(ID_NAMESPACE, f"resource:{resource_name}"))
   return str(uuid.uuid4())
 
 
@@ -27,6 +120,30 @@ def safe_json_dumps(data):
   return json.dumps(data, ensure_ascii=False, default=str) if data is not None else ""
 
 
+def parse_timestamp(value):
+  # Parse a CloudTrail timestamp into a UTC datetime; empty or malformed values become None.
+  # Other ISO 8601 forms (fractional seconds, numeric offsets) fall back to fromisoformat.
+  if not value:
+    return None
+  try:
+    return datetime.datetime.strptime(value, TIMESTAMP_FORMAT).replace(tzinfo=datetime.timezone.utc)
+  except (TypeError, ValueError):
+    pass
+  try:
+    parsed = datetime.datetime.fromisoformat(value.replace("Z", "+00:00"))
+  except (AttributeError, TypeError, ValueError):
+    print(f"Error parsing date: {value}")
+    return None
+  if parsed.tzinfo is None:
+    return parsed.replace(tzinfo=datetime.timezone.utc)
+  return parsed.astimezone(datetime.timezone.utc)
+
+
+def spark_schema(table_name):
+  # Spark schema of a table, from its TABLE_COLUMNS types
+  return StructType([StructField(name, SPARK_TYPES[sql_type], True) for name, sql_type in TABLE_COLUMNS[table_name]])
+
+
 def safe_get(data, key, default=''):
   # Safely get a value from a dictionary; return default if key is missing or value is None
   if data is None:
@@ -34,79 +151,131 @@ def safe_get(data, key, default=''):
   return data.get(key) or default
 
 
-def infer_resource_type(request_params):
+# Built-in rules used by infer_resource_type(), in priority order: the first rule that matches wins.
+# A rule matches when every key of one of its "when" alternatives is present in requestParameters.
+# An alternative can also require a key's value to start with a string ("prefix") or to be a list ("list").
+DEFAULT_RESOURCE_RULES = [
+  {"type": "cloudtrailtrail", "when": [
+    {"keys": ["trailNameList"]},
+    {"keys": ["name", "s3BucketName"]},
+    {"keys": ["name", "enableLogFileValidation"]}]},
+  {"type": "s3bucket", "when": [
+    {"keys": ["bucketName", "CreateBucketConfiguration"]},
+    {"keys": ["bucketName", "bucketPolicy"]},
+    {"keys": ["bucketName", "logging"]},
+    {"keys": ["bucketName", "replication"]},
+    {"keys": ["bucketName", "website"]},
+    {"keys": ["bucketName", "acl"]},
+    {"keys": ["bucketName", "tagging"]},
+    {"keys": ["bucketName", "versioning"]},
+    {"keys": ["bucketName", "policy"], "list": ["policy"]}]},
+  {"type": "ec2instance", "when": [{"keys": ["instancesSet"]}]},
+  {"type": "ami", "when": [{"keys": ["imagesSet"]}, {"keys": ["imageId"], "prefix": {"imageId": "ami-"}}]},
+  {"type": "volume", "when": [{"keys": ["volumeSet"]}, {"keys": ["volumeId"]}]},
+  {"type": "snapshot", "when": [{"keys": ["snapshotSet"]}, {"keys": ["snapshotId"]}]},
+  {"type": "availabilityzone", "when": [{"keys": ["availabilityZoneSet"]}]},
+  {"type": "securitygroup", "when": [
+    {"keys": ["securityGroupSet"]}, {"keys": ["securityGroupIdSet"]}, {"keys": ["ipPermissions"]}]},
+  {"type": "subnet", "when": [{"keys": ["subnetSet"]}, {"keys": ["subnetId"]}]},
+  {"type": "vpc", "when": [{"keys": ["vpcSet"]}, {"keys": ["vpcId"]}]},
+  {"type": "iamrole", "when": [
+    {"keys": ["roleName", "assumeRolePolicyDocument"]}, {"keys": ["roleName", "policyDocument"]}]},
+  {"type": "iampolicy", "when": [{"keys": ["policyName"]}, {"keys": ["policyArn"]}]},
+  {"type": "iaminstanceprofile", "when": [{"keys": ["instanceProfileName"]}]},
+  {"type": "lambdafunction", "when": [{"keys": ["functionName", "handler"]}]},
+  {"type": "apigateway", "when": [{"keys": ["restApiId"]}]},
+  {"type": "cloudformationstack", "when": [{"keys": ["stackStatusFilter"]}]},
+  {"type": "awsconfig", "when": [{"keys": ["configurationRecorder"]}, {"keys": ["deliveryChannel"]}]},
+  {"type": "customergateway", "when": [{"keys": ["customerGatewaySet"]}]},
+  {"type": "dhcptoptions", "when": [{"keys": ["dhcpOptionsSet"]}]},
+  {"type": "networkacl", "when": [{"keys": ["networkAclIdSet"]}]},
+  {"type": "reservedorspotinstances", "when": [
+    {"keys": ["reservedInstancesSet"]}, {"keys": ["spotInstanceRequestIdSet"]}]},
+  {"type": "codecommit", "when": [{"keys": ["repositoryNames"]}]},
+  {"type": "acmcertificate", "when": [{"keys": ["certificateStatuses"]}]},
+  {"type": "mfadevice", "when": [{"keys": ["virtualMFADeviceName"]}, {"keys": ["serialNumber"]}]},
+  {"type": "genericquery", "when": [
+    {"keys": ["maxResults"]}, {"keys": ["nextToken"]}, {"keys": ["filterSet"]}, {"keys": ["pageSize"]},
+    {"keys": ["limit"]}]},
+]
+
+
+class ResourceTypeRules:
+  # Resource type rules compiled into an index from trigger key to the rule alternatives that key can satisfy,
+  # so a record only looks up its own requestParameters keys once instead of walking every rule. Results are
+  # cached per key set; records with keys whose values a rule inspects bypass the cache.
+
+  CACHE_SIZE = 65536
+
+  def __init__(self, rules):
+    self.index = {}
+    self.cache = {}
+    self.value_keys = set()
+    for priority, rule in enumerate(rules):
+      for condition in rule["when"]:
+        trigger, *other_keys = condition["keys"]
+        self.index.setdefault(trigger, []).append(
+          (priority, rule["type"], other_keys, condition.get("prefix", {}), condition.get("list", [])))
+        self.value_keys.update(condition.get("prefix", {}), condition.get("list", []))
+    for alternatives in self.index.values():
+      alternatives.sort(key=lambda alternative: alternative[0])
+
+  @classmethod
+  def from_file(cls, rules_file):
+    # Load rules from a JSON file; they take precedence over the built-in rules. Raises ValueError naming the
+    # first rule without a type or with a condition whose keys list is empty
+    with open(rules_file) as f:
+      rules = json.load(f)
+    if not isinstance(rules, list):
+      raise ValueError(f"{rules_file} must hold a JSON list of resource type rules")
+    for number, rule in enumerate(rules, 1):
+      if not (isinstance(rule, dict) and rule.get("type") and isinstance(rule.get("when"), list) and rule["when"]
+              and all(isinstance(condition, dict) and condition.get("keys") for condition in rule["when"])):
+        raise ValueError(f"Resource type rule #{number} in {rules_file} needs a type and a non-empty "
+                         f"\"keys\" list in each \"when\" condition: {json.dumps(rule)}")
+    return cls(rules + DEFAULT_RESOURCE_RULES)
+
+  def infer(self, request_params):
+    if not self.value_keys.isdisjoint(request_params):
+      return self.match(request_params)
+    keys = tuple(request_params)
+    resource_type = self.cache.get(keys)
+    if resource_type is None:
+      if len(self.cache) >= self.CACHE_SIZE:
+        self.cache.clear()
+      resource_type = self.cache[keys] = self.match(request_params)
+    return resource_type
+
+  def match(self, request_params):
+    best_priority, best_type = None, ''
+    for key in request_params:
+      for priority, resource_type, other_keys, prefixes, list_keys in self.index.get(key, ()):
+        if best_priority is not None and priority >= best_priority:
+          break
+        if (all(other in request_params for other in other_keys)
+                and all(isinstance(request_params.get(k), str) and request_params[k].startswith(prefix)
+                        for k, prefix in prefixes.items())
+                and all(isinstance(request_params.get(k), list) for k in list_keys)):
+          best_priority, best_type = priority, resource_type
+          break
+    return best_type
+
+
+RESOURCE_RULES = ResourceTypeRules(DEFAULT_RESOURCE_RULES)
+
+
+def infer_resource_type(request_params, rules=None):
   # Infer resource type based on keys in requestParameters; return a tuple: (resource_type, extra_metadata)
   if not request_params:
     return '', {}
-  if 'trailNameList' in request_params or ('name' in request_params and (
-          's3BucketName' in request_params or 'enableLogFileValidation' in request_params)):
-    return 'cloudtrailtrail', {}
-  if 'bucketName' in request_params and (
-          'CreateBucketConfiguration' in request_params or
-          'bucketPolicy' in request_params or
-          'logging' in request_params or
-          'replication' in request_params or
-          'website' in request_params or
-          'acl' in request_params or
-          'tagging' in request_params or
-          'versioning' in request_params or
-          ('policy' in request_params and isinstance(request_params.get('policy'), list))):
-    return 's3bucket', {}
-  if 'instancesSet' in request_params:
-    return 'ec2instance', {}
-  if 'imagesSet' in request_params or (
-          'imageId' in request_params and request_params.get('imageId', '').startswith('ami-')):
-    return 'ami', {}
-  if 'volumeSet' in request_params or 'volumeId' in request_params:
-    return 'volume', {}
-  if 'snapshotSet' in request_params or 'snapshotId' in request_params:
-    return 'snapshot', {}
-  if 'availabilityZoneSet' in request_params:
-    return 'availabilityzone', {}
-  if 'securityGroupSet' in request_params or 'securityGroupIdSet' in request_params or 'ipPermissions' in request_params:
-    return 'securitygroup', {}
-  if 'subnetSet' in request_params or 'subnetId' in request_params:
-    return 'subnet', {}
-  if 'vpcSet' in request_params or 'vpcId' in request_params:
-    return 'vpc', {}
-  if 'roleName' in request_params and (
-          'assumeRolePolicyDocument' in request_params or 'policyDocument' in request_params):
-    return 'iamrole', {}
-  if 'policyName' in request_params or 'policyArn' in request_params:
-    return 'iampolicy', {}
-  if 'instanceProfileName' in request_params:
-    return 'iaminstanceprofile', {}
-  if 'functionName' in request_params and 'handler' in request_params:
-    return 'lambdafunction', {}
-  if 'restApiId' in request_params:
-    return 'apigateway', {}
-  if 'stackStatusFilter' in request_params:
-    return 'cloudformationstack', {}
-  if 'configurationRecorder' in request_params or 'deliveryChannel' in request_params:
-    return 'awsconfig', {}
-  if 'customerGatewaySet' in request_params:
-    return 'customergateway', {}
-  if 'dhcpOptionsSet' in request_params:
-    return 'dhcptoptions', {}
-  if 'networkAclIdSet' in request_params:
-    return 'networkacl', {}
-  if 'reservedInstancesSet' in request_params or 'spotInstanceRequestIdSet' in request_params:
-    return 'reservedorspotinstances', {}
-  if 'repositoryNames' in request_params:
-    return 'codecommit', {}
-  if 'certificateStatuses' in request_params:
-    return 'acmcertificate', {}
-  if 'virtualMFADeviceName' in request_params or 'serialNumber' in request_params:
-    return 'mfadevice', {}
-  if any(k in request_params for k in ['maxResults', 'nextToken', 'filterSet', 'pageSize', 'limit']):
-    return 'genericquery', {}
-  return '', {}
-
-
-def process_files(input_folder):
+  return (rules or RESOURCE_RULES).infer(request_params), {}
+
+
+def process_files(input_folder, rules=None, stable_ids=False):
   """
   Process all JSON files in the input folder, extract data for each table,
   and return six lists corresponding to account, identity, session, event, resource, and eventresource.
+  With stable_ids, session and resource IDs are derived from their natural keys instead of being random.
   """
   accounts_rows = []
   identity_rows = []
@@ -137,9 +306,9 @@ def process_files(input_folder):
             accounts_set.add(account_id)
             accounts_rows.append({
               "account_id": str(account_id),
-              "account_alias": fake.user_name(),
-              "email": fake.email(),
-              "phone": fake.phone_number()
+              "account_alias": "",
+              "email": "",
+              "phone": ""
             })
 
           # Process identity table
@@ -160,7 +329,7 @@ def process_files(input_folder):
           attributes = session_context.get("attributes", {}) or {}
           creation_date = safe_get(attributes, "creationDate")
           if creation_date:
-            session_id = generate_session_id(identity_id, creation_date)
+            session_id = generate_session_id(identity_id, creation_date, stable_ids)
             if session_id not in sessions_set:
               sessions_set.add(session_id)
               additional_info = {
@@ -169,7 +338,7 @@ def process_files(input_folder):
               }
               session_rows.append({
                 "session_id": session_id,
-                "creation_date": creation_date,
+                "creation_date": parse_timestamp(creation_date),
                 "mfa_authenticated": str(safe_get(attributes, "mfaAuthenticated", "false")).lower() == "true",
                 "additional_info": safe_json_dumps(additional_info),
                 "identity_id": identity_id
@@ -188,7 +357,7 @@ def process_files(input_folder):
           response_params_raw = record.get("responseElements") or {}
           event_rows.append({
             "event_id": event_id,
-            "event_time": event_time,
+            "event_time": parse_timestamp(event_time),
             "event_source": event_source,
             "event_name": event_name,
             "source_ip": source_ip,
@@ -208,7 +377,7 @@ def process_files(input_folder):
             natural_name = safe_get(item, "instanceId")
             if natural_name and natural_name not in resources_set:
               resources_set.add(natural_name)
-              generated_resource_id = generate_resource_id()
+              generated_resource_id = generate_resource_id(natural_name, stable_ids)
               resource_rows.append({
                 "resource_id": generated_resource_id,
                 "resource_name": natural_name,
@@ -223,7 +392,7 @@ def process_files(input_folder):
               })
 
           # Process resource table inferred from requestParameters as fallback
-          resource_type, extra_metadata = infer_resource_type(record.get("requestParameters") or {})
+          resource_type, extra_metadata = infer_resource_type(record.get("requestParameters") or {}, rules)
           if resource_type:
             natural_name = safe_get(record.get("requestParameters") or {}, "name")
             if not natural_name:
@@ -232,7 +401,7 @@ def process_files(input_folder):
               natural_name = safe_get(record.get("requestParameters") or {}, "instanceId")
             if natural_name and natural_name not in resources_set:
               resources_set.add(natural_name)
-              generated_resource_id = generate_resource_id()
+              generated_resource_id = generate_resource_id(natural_name, stable_ids)
               resource_rows.append({
                 "resource_id": generated_resource_id,
                 "resource_name": natural_name,
@@ -252,115 +421,109 @@ def process_files(input_folder):
   return accounts_rows, identity_rows, session_rows, event_rows, resource_rows, event_resource_rows
 
 
-def create_tables(spark, database):
+def parse_table_option(values, option):
+  # Parse repeated "table=item,item" options into {table: [items]}; commas inside parentheses,
+  # as in bucket(16, account_id), do not split items
+  result = {}
+  for value in values or []:
+    table_name, separator, items = value.partition("=")
+    if not separator or table_name not in TABLE_COLUMNS:
+      raise ValueError(f"{option} expects TABLE=ITEM[,ITEM...] with TABLE one of {', '.join(TABLE_COLUMNS)}, "
+                       f"got {value!r}")
+    result[table_name] = [item.strip() for item in re.split(r",(?![^()]*\))", items) if item.strip()]
+  return result
+
+
+def create_tables(spark, database, partitions=None, sort_orders=None, target_file_size_mb=None):
   """
   Create namespace and 6 tables (account, identity, session, event, resource, eventresource)
   in the specified database using the default warehouse from the REST catalog.
-  All names are in lowercase.
+  All names are in lowercase. The columns come from TABLE_COLUMNS.
+  :param partitions: Optional {table: [partition transform, ...]}, e.g. {"event": ["days(event_time)"]}.
+  :param sort_orders: Optional {table: [sort column, ...]} used as the table's write order.
+  :param target_file_size_mb: Optional target size of the data files written to every table.
   """
+  partitions = partitions or {}
+  sort_orders = sort_orders or {}
+
   # Create namespace
   spark.sql(f"CREATE NAMESPACE IF NOT EXISTS {database}")
   print(f"Namespace '{database}' created or already exists.")
 
-  # Create account table
-  spark.sql(f"""
-        CREATE TABLE IF NOT EXISTS {database}.account (
-            account_id STRING,
-            account_alias STRING,
-            email STRING,
-            phone STRING
-        )
-        USING iceberg
-    """)
-  print("account table created.")
-
-  # Create identity table
-  spark.sql(f"""
-        CREATE TABLE IF NOT EXISTS {database}.identity (
-            identity_id STRING,
-            type STRING,
-            principal_id STRING,
-            arn STRING,
-            user_name STRING,
-            account_id STRING
-        )
-        USING iceberg
-    """)
-  print("identity table created.")
-
-  # Create session table
-  spark.sql(f"""
-        CREATE TABLE IF NOT EXISTS {database}.session (
-            session_id STRING,
-            creation_date TIMESTAMP,
-            mfa_authenticated BOOLEAN,
-            additional_info STRING,
-            identity_id STRING
-        )
-        USING iceberg
-    """)
-  print("session table created.")
-
-  # Create event table
-  spark.sql(f"""
-        CREATE TABLE IF NOT EXISTS {database}.event (
-            event_id STRING,
-            event_time TIMESTAMP,
-            event_source STRING,
-            event_name STRING,
-            source_ip STRING,
-            user_agent STRING,
-            request_params STRING,
-            response_params STRING,
-            identity_id STRING,
-            session_id STRING,
-            account_id STRING
-        )
-        USING iceberg
-    """)
-  print("event table created.")
-
-  # Create resource table
-  spark.sql(f"""
-        CREATE TABLE IF NOT EXISTS {database}.resource (
-            resource_id STRING,
-            resource_name STRING,
-            resource_type STRING,
-            additional_metadata STRING
+  # Create each table
+  for table_name, columns in TABLE_COLUMNS.items():
+    column_ddl = ",\n            ".join(f"{name} {sql_type}" for name, sql_type in columns)
+    partition_ddl = f"\n        PARTITIONED BY ({', '.join(partitions[table_name])})" if table_name in partitions else ""
+    spark.sql(f"""
+        CREATE TABLE IF NOT EXISTS {database}.{table_name} (
+            {column_ddl}
         )
-        USING iceberg
+        USING iceberg{partition_ddl}
     """)
-  print("resource table created.")
-
-  # Create eventresource table
-  spark.sql(f"""
-        CREATE TABLE IF NOT EXISTS {database}.eventresource (
-            event_id STRING,
-            resource_id STRING,
-            pre_state STRING,
-            post_state STRING
-        )
-        USING iceberg
-    """)
-  print("eventresource table created.")
+    # The write order and file size also apply to an existing table; the partition spec only on creation
+    if target_file_size_mb:
+      spark.sql(f"ALTER TABLE {database}.{table_name} SET TBLPROPERTIES "
+                f"('write.target-file-size-bytes' = '{target_file_size_mb * 1024 * 1024}')")
+    if table_name in sort_orders:
+      spark.sql(f"ALTER TABLE {database}.{table_name} WRITE ORDERED BY {', '.join(sort_orders[table_name])}")
+    print(f"{table_name} table created.")
+
+
+def compact_tables(spark, database, sort_orders=None, target_file_size_mb=None):
+  """
+  Compact the small data files left by the batch inserts with Iceberg's rewrite_data_files procedure,
+  sorting the tables that have a write order. Prints the files rewritten and the time taken per table.
+  """
+  catalog = spark.conf.get("spark.sql.defaultCatalog", "spark_catalog")
+  for table_name in TABLE_COLUMNS:
+    start_time = time.time()
+    strategy = ", strategy => 'sort'" if table_name in (sort_orders or {}) else ""
+    options = (f", options => map('target-file-size-bytes', '{target_file_size_mb * 1024 * 1024}')"
+               if target_file_size_mb else "")
+    result = spark.sql(f"CALL {catalog}.system.rewrite_data_files("
+                       f"table => '{database}.{table_name}'{strategy}{options})").collect()[0]
+    print(f"Compacted {database}.{table_name}: {result['rewritten_data_files_count']} data files rewritten into "
+          f"{result['added_data_files_count']} in {time.time() - start_time:.1f}s.")
+
+
+def commit_with_retry(commit, description, retries=COMMIT_RETRIES):
+  # Run a Spark action that commits to an Iceberg table, retrying it when the commit fails on a concurrent
+  # update (CommitFailedException). A failed commit leaves no data behind, so a retry cannot duplicate rows;
+  # any other error, including an unknown commit state, is raised immediately.
+  for attempt in range(retries + 1):
+    try:
+      return commit()
+    except Exception as e:
+      if "CommitFailedException" not in str(e) or attempt == retries:
+        raise
+      delay = COMMIT_RETRY_DELAY * 2 ** attempt
+      print(f"Commit conflict on {description}, retrying in {delay:g}s ({attempt + 1}/{retries}).")
+      time.sleep(delay)
 
 
-def insert_data_in_batches(spark, data, table_name, database, columns, batch_size=100000, insert_sql_template=None):
+def insert_data_in_batches(spark, data, table_name, database, columns=None, batch_size=100000,
+                           insert_sql_template=None):
   """
-  Insert data into a table in batches using Spark SQL.
+  Insert data into a table in batches using Spark SQL. Each batch is created with the table's
+  explicit Spark schema (see spark_schema()), so no type inference or casting is needed.
   :param spark: SparkSession
   :param data: List of dicts representing rows.
   :param table_name: Target table name (in lowercase)
   :param database: Target namespace (database)
-  :param columns: List of column names in the desired order.
+  :param columns: List of column names in the desired order (default: the table's columns).
   :param batch_size: Maximum number of rows per batch.
   :param insert_sql_template: Optional customized SQL template (with placeholders {database}, {table}, {view})
+  :return: Elapsed seconds.
   """
+  start_time = time.time()
+  schema = spark_schema(table_name)
+  names = schema.fieldNames()
+  columns = columns or names
   total = len(data)
   print(f"Inserting {total} rows into {database}.{table_name} in batches of {batch_size}...")
   for start in range(0, total, batch_size):
     chunk = data[start:start + batch_size]
-    df_chunk = spark.createDataFrame(chunk)
+    df_chunk = spark.createDataFrame([tuple(row.get(name) for name in names) for row in chunk], schema)
     # Ensure correct column order by selecting the columns explicitly
     df_chunk = df_chunk.select(*columns)
     view_name = f"temp_{table_name}"
@@ -369,56 +532,129 @@ def insert_data_in_batches(spark, data, table_name, database, columns, batch_siz
       sql_str = insert_sql_template.format(database=database, table=table_name, view=view_name)
     else:
       sql_str = f"INSERT INTO {database}.{table_name} SELECT * FROM {view_name}"
-    spark.sql(sql_str)
+    commit_with_retry(lambda: spark.sql(sql_str), f"{database}.{table_name}")
     print(f"Inserted rows {start} to {start + len(chunk)} into {database}.{table_name}.")
+  return time.time() - start_time
+
+
+def arrow_schema(table_name):
+  # Arrow schema of a table, from its TABLE_COLUMNS Spark SQL types
+  import pyarrow as pa
+  arrow_types = {"STRING": pa.string(), "BOOLEAN": pa.bool_(), "TIMESTAMP": pa.timestamp("us", tz="UTC")}
+  return pa.schema([(name, arrow_types[sql_type]) for name, sql_type in TABLE_COLUMNS[table_name]])
 
 
-def insert_data(spark, accounts, identity, session, event, resource, eventresource, database):
+def rows_to_arrow(rows, schema):
+  # Build an Arrow table from row dicts with an explicit schema (timestamps are already parsed datetimes)
+  import pyarrow as pa
+  return pa.Table.from_pylist(rows, schema)
+
+
+@contextlib.contextmanager
+def arrow_dataframe(spark, data, table_name, batch_size=100000):
+  # Convert rows to Arrow record batches with the table's explicit schema, stage them in a local Parquet
+  # file one batch at a time and yield a DataFrame that Spark reads from it, so neither a pandas copy nor
+  # the whole table in Arrow memory is needed. The staged file is removed when the block exits.
+  import pyarrow.parquet as pq
+  schema = arrow_schema(table_name)
+  staging_dir = tempfile.mkdtemp(prefix=f"staged_{table_name}_")
+  try:
+    staged_file = os.path.join(staging_dir, f"{table_name}.parquet")
+    with pq.ParquetWriter(staged_file, schema) as writer:
+      for start in range(0, len(data), batch_size):
+        writer.write_table(rows_to_arrow(data[start:start + batch_size], schema))
+    yield spark.read.schema(spark_schema(table_name)).parquet(staged_file)
+  finally:
+    shutil.rmtree(staging_dir, ignore_errors=True)
+
+
+def insert_data_arrow(spark, data, table_name, database, batch_size=100000):
+  """
+  Insert data into a table with a single DataFrame write of Arrow record batches staged as Parquet
+  (see arrow_dataframe()), instead of a DataFrame, temp view and INSERT per batch.
+  Returns the elapsed seconds.
   """
-  Insert data for each table in batches, specifying column order to avoid schema misalignment.
+  start_time = time.time()
+  print(f"Inserting {len(data)} rows into {database}.{table_name} as Arrow record batches...")
+  with arrow_dataframe(spark, data, table_name, batch_size) as df:
+    commit_with_retry(lambda: df.writeTo(f"{database}.{table_name}").append(), f"{database}.{table_name}")
+  return time.time() - start_time
+
+
+def unique_rows(data, keys):
+  # Keep the first row for each key, since MERGE fails when several source rows match one target row
+  seen = set()
+  rows = []
+  for row in data:
+    key = tuple(row[k] for k in keys)
+    if key not in seen:
+      seen.add(key)
+      rows.append(row)
+  return rows
+
+
+def merge_data(spark, data, table_name, database, arrow=False):
   """
-  # Insert account table: columns order: account_id, account_alias, email, phone
-  if accounts:
-    insert_data_in_batches(spark, accounts, "account", database,
-                           columns=["account_id", "account_alias", "email", "phone"])
-  # Insert identity table: columns order: identity_id, type, principal_id, arn, user_name, account_id
-  if identity:
-    insert_data_in_batches(spark, identity, "identity", database,
-                           columns=["identity_id", "type", "principal_id", "arn", "user_name", "account_id"])
-  # Insert session table: columns order: session_id, creation_date, mfa_authenticated, additional_info, identity_id
-  if session:
-    insert_sql = ("""
-            INSERT INTO {database}.session 
-            SELECT session_id, CAST(creation_date AS TIMESTAMP) AS creation_date, 
-                   mfa_authenticated, additional_info, identity_id 
-            FROM {view}
-        """)
-    insert_data_in_batches(spark, session, "session", database,
-                           columns=["session_id", "creation_date", "mfa_authenticated", "additional_info",
-                                    "identity_id"],
-                           insert_sql_template=insert_sql)
-  # Insert event table: columns order: event_id, event_time, event_source, event_name, source_ip, user_agent,
-  # request_params, response_params, identity_id, session_id, account_id
-  if event:
-    insert_sql = ("""
-            INSERT INTO {database}.event 
-            SELECT event_id, CAST(event_time AS TIMESTAMP) AS event_time, event_source, event_name, 
-                   source_ip, user_agent, request_params, response_params, identity_id, session_id, 
-                   CAST(account_id AS STRING) as account_id
-            FROM {view}
-        """)
-    insert_data_in_batches(spark, event, "event", database,
-                           columns=["event_id", "event_time", "event_source", "event_name", "source_ip", "user_agent",
-                                    "request_params", "response_params", "identity_id", "session_id", "account_id"],
-                           insert_sql_template=insert_sql)
-  # Insert resource table: columns order: resource_id, resource_name, resource_type, additional_metadata
-  if resource:
-    insert_data_in_batches(spark, resource, "resource", database,
-                           columns=["resource_id", "resource_name", "resource_type", "additional_metadata"])
-  # Insert eventresource table: columns order: event_id, resource_id, pre_state, post_state
-  if eventresource:
-    insert_data_in_batches(spark, eventresource, "eventresource", database,
-                           columns=["event_id", "resource_id", "pre_state", "post_state"])
+  Merge data into a table on its natural key (MERGE_KEYS): all rows are staged as one temp view and
+  merged in a single commit, inserting only the rows whose key is not in the table yet. CloudTrail
+  records never change, so re-running a load or loading overlapping logs does not duplicate rows.
+  Returns the elapsed seconds.
+  """
+  start_time = time.time()
+  keys = MERGE_KEYS[table_name]
+  rows = unique_rows(data, keys)
+  print(f"Merging {len(rows)} rows into {database}.{table_name} on {', '.join(keys)}...")
+  if arrow:
+    staged = arrow_dataframe(spark, rows, table_name)
+  else:
+    schema = spark_schema(table_name)
+    staged = contextlib.nullcontext(
+      spark.createDataFrame([tuple(row.get(name) for name in schema.fieldNames()) for row in rows], schema))
+  view_name = f"staged_{table_name}"
+  condition = " AND ".join(f"target.{key} = source.{key}" for key in keys)
+  sql_str = (f"MERGE INTO {database}.{table_name} AS target USING {view_name} AS source ON {condition} "
+             f"WHEN NOT MATCHED THEN INSERT *")
+  with staged as df:
+    df.createOrReplaceTempView(view_name)
+    commit_with_retry(lambda: spark.sql(sql_str), f"{database}.{table_name}")
+  return time.time() - start_time
+
+
+def report_insert(database, table_name, rows, seconds):
+  # Print the insert throughput of a table
+  print(f"Inserted {rows} rows into {database}.{table_name} in {seconds:.1f}s ({rows / max(seconds, 1e-9):.0f} rows/sec).")
+
+
+def insert_data(spark, accounts, identity, session, event, resource, eventresource, database, mode="sql",
+                workers=1, write_mode="append"):
+  """
+  Insert data for each table in batches, with the column order and types of TABLE_COLUMNS.
+  With mode="arrow" each table is loaded with insert_data_arrow() instead, and with write_mode="merge"
+  each table is merged on its natural key with merge_data(). The rows/sec of each table is reported.
+  With workers > 1, up to that many tables are written concurrently as Spark jobs from a thread pool,
+  so their Iceberg commits overlap instead of each waiting for the previous table.
+  """
+  if write_mode == "merge":
+    insert = functools.partial(merge_data, arrow=mode == "arrow")
+  else:
+    insert = insert_data_arrow if mode == "arrow" else insert_data_in_batches
+  tables = [(table_name, rows) for table_name, rows in (("account", accounts), ("identity", identity),
+                                                        ("session", session), ("event", event),
+                                                        ("resource", resource), ("eventresource", eventresource))
+            if rows]
+  if workers <= 1:
+    for table_name, rows in tables:
+      report_insert(database, table_name, len(rows), insert(spark, rows, table_name, database))
+    return
+
+  start_time = time.time()
+  with ThreadPoolExecutor(max_workers=workers) as executor:
+    futures = {executor.submit(insert, spark, rows, table_name, database): (table_name, rows)
+               for table_name, rows in tables}
+    for future in as_completed(futures):
+      table_name, rows = futures[future]
+      report_insert(database, table_name, len(rows), future.result())
+  print(f"Inserted {len(tables)} tables concurrently in {time.time() - start_time:.1f}s.")
 
 
 def main():
@@ -428,19 +664,60 @@ def main():
   parser.add_argument("json_folder", help="Path to the folder containing JSON files.")
   parser.add_argument("--database", default="security_graph",
                       help="Target database (namespace) in the REST catalog. Use lowercase.")
+  parser.add_argument("--stable-ids", action="store_true",
+                      help="Derive session and resource IDs from their natural keys instead of random UUIDs.")
+  parser.add_argument("--account-details", choices=ACCOUNT_DETAILS_MODES, default="faker",
+                      help="Sample account alias/email/phone: Faker seeded per account (default), "
+                           "a Faker-free hash of the account ID, or none.")
+  parser.add_argument("--insert-mode", choices=["sql", "arrow"], default="sql",
+                      help="sql: INSERT from a temp view per batch; arrow: one DataFrame write per table from "
+                           "Arrow record batches staged as Parquet (needs pyarrow).")
+  parser.add_argument("--write-mode", choices=["append", "merge"], default="append",
+                      help="append: INSERT every row; merge: MERGE on natural keys so that re-runs and "
+                           "overlapping loads do not duplicate rows (use with --stable-ids).")
+  parser.add_argument("--table-workers", type=int, default=1,
+                      help="Number of tables written concurrently (default: 1, one after another).")
+  parser.add_argument("--partition-by", action="append", metavar="TABLE=SPEC[,SPEC]",
+                      help="Partition spec of a new table, e.g. event=days(event_time),bucket(16,account_id). "
+                           "Can be repeated.")
+  parser.add_argument("--sort-by", action="append", metavar="TABLE=COLUMN[,COLUMN]",
+                      help="Write order of a table, e.g. event=account_id,event_time. Can be repeated.")
+  parser.add_argument("--target-file-size-mb", type=int, default=None,
+                      help="Target size of the data files written to each table.")
+  parser.add_argument("--compact", action="store_true",
+                      help="Compact the tables with rewrite_data_files after loading.")
+  parser.add_argument("--resource-rules", default=None,
+                      help="JSON file with extra resource type rules, checked before the built-in ones.")
   args = parser.parse_args()
+  try:
+    partitions = parse_table_option(args.partition_by, "--partition-by")
+    sort_orders = parse_table_option(args.sort_by, "--sort-by")
+    rules = ResourceTypeRules.from_file(args.resource_rules) if args.resource_rules else RESOURCE_RULES
+  except ValueError as e:
+    parser.error(str(e))
+  if args.write_mode == "merge" and not args.stable_ids:
+    print("Warning: without --stable-ids, resources get new random IDs on every run, "
+          "so merged eventresource rows will not match the resources already loaded.")
 
   # Create SparkSession; external spark-submit should pass necessary catalog configs
   spark = SparkSession.builder.appName("JsonToS3Tables").getOrCreate()
 
   # Create namespace and tables
-  create_tables(spark, args.database)
+  create_tables(spark, args.database, partitions, sort_orders, args.target_file_size_mb)
 
   # Process JSON files and obtain data for each table
-  accounts, identity, session, event, resource, eventresource = process_files(args.json_folder)
+  accounts, identity, session, event, resource, eventresource = process_files(args.json_folder, rules, args.stable_ids)
+
+  # Sample account details for all accounts in one batch
+  enrich_accounts(accounts, args.account_details)
 
   # Insert data into tables via Spark SQL
-  insert_data(spark, accounts, identity, session, event, resource, eventresource, args.database)
+  insert_data(spark, accounts, identity, session, event, resource, eventresource, args.database, args.insert_mode,
+              args.table_workers, args.write_mode)
+
+  # Rewrite the small files of the batch inserts into target-size (and sorted) files
+  if args.compact:
+    compact_tables(spark, args.database, sort_orders, args.target_file_size_mb)
 
   print("Data processing and insertion completed.")
 